@@ -1,41 +1,152 @@
 import asyncio
-from pyrogram import Client, filters
+import cProfile
+import hashlib
+import io
+import json
+import logging
+import pstats
+import random
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from aiohttp import web
+from pyrogram import Client, filters, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
+from pyrogram.errors import (
+    FloodWait, RPCError, InternalServerError, MessageNotModified,
+    UserIsBlocked, InputUserDeactivated, PeerIdInvalid
+)
 import re
-from pymongo import MongoClient
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 from config import API_HASH, API_ID, BOT_TOKEN, MONGO_URI, START_PIC, START_MSG, HELP_TXT, OWNER_ID
+from config import CONFIG_CACHE_SIZE, CONFIG_CACHE_TTL, FILE_INFO_CACHE_SIZE
+from config import BROADCAST_WORKERS, BROADCAST_RATE, BROADCAST_RETRIES
+from config import DISPATCH_WORKERS, SHUTDOWN_DRAIN_TIMEOUT, EDIT_GLOBAL_RATE, EDIT_CHAT_RATE, EDIT_CHAT_BURST, EDIT_RETRIES
+from config import RECENT_POSTS_PER_CHAT, METRICS_HOST, METRICS_PORT
+from config import PROFILE_SECONDS, PROFILE_MAX_SECONDS, PROFILE_TOP, PROFILE_SLOW_CALLBACK
+from config import LOG_LEVEL, LOG_RATE_LIMIT, LOG_RATE_WINDOW
+from config import BACKFILL_BATCH, BACKFILL_CONCURRENCY
+from config import KNOWN_USERS_CACHE_SIZE, USER_FLUSH_BATCH, USER_FLUSH_INTERVAL
+from config import STATS_RECONCILE_INTERVAL, MYCAPTIONS_PAGE_SIZE
 
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = AsyncIOMotorClient(MONGO_URI)
 db = mongo_client["auto_caption_bot"]
-channels_collection = db["channel_captions"]
+configs_collection = db["channel_configs"]
 users_collection = db["users"]
+dead_letters_collection = db["dead_letters"]
+caption_jobs_collection = db["caption_jobs"]
+backfills_collection = db["backfills"]
+
+# Legacy per-feature collections, folded into channel_configs at startup
+channels_collection = db["channel_captions"]
 text_settings_collection = db["text_settings"]
 button_collection = db["custom_buttons"]
 
 app = Client("auto_caption_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
-# Pre-compiled regex patterns for better performance
-QUALITY_PATTERNS = [
-    (re.compile(r'\b(4K|2160p|UHD)\b', re.IGNORECASE), "4K"),
-    (re.compile(r'\b(1080p|FHD)\b', re.IGNORECASE), "1080p"),
-    (re.compile(r'\b(720p|HD)\b', re.IGNORECASE), "720p"),
-    (re.compile(r'\b(480p|SD)\b', re.IGNORECASE), "480p"),
-    (re.compile(r'\b(360p|LD)\b', re.IGNORECASE), "360p")
+# Errors worth retrying: Telegram server side failures and network trouble
+TRANSIENT_ERRORS = (InternalServerError, asyncio.TimeoutError, OSError)
+
+log = logging.getLogger("juzi")
+
+# Structured fields callers pass with extra={...}
+LOG_FIELDS = ("chat_id", "message_id", "stage", "duration", "suppressed")
+
+class LogQueueHandler(QueueHandler):
+    """Hands records to the listener thread untouched; formatting, tracebacks included, happens there"""
+    def prepare(self, record):
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogRateLimiter(logging.Filter):
+    """Lets through at most `limit` records per message and chat every `window` seconds.
+    The first record after a quiet spell carries how many were dropped."""
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.keys = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.name, record.msg, getattr(record, "chat_id", None))
+        entry = self.keys.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if len(self.keys) > 10000:
+                self.keys = {k: v for k, v in self.keys.items() if now - v[0] < self.window}
+            if entry and entry[2]:
+                record.suppressed = entry[2]
+            self.keys[key] = [now, 1, 0]
+            return True
+        if entry[1] < self.limit:
+            entry[1] += 1
+            return True
+        entry[2] += 1
+        return False
+
+def setup_logging():
+    """Route every logger through a queue so writing to stderr never blocks the event loop"""
+    records = SimpleQueue()
+    handler = LogQueueHandler(records)
+    handler.addFilter(LogRateLimiter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    listener = QueueListener(records, output)
+    listener.start()
+    return listener
+
+# Whole-word tags, highest priority first
+QUALITY_WORDS = [
+    (("4K", "2160p", "UHD"), "4K"),
+    (("1080p", "FHD"), "1080p"),
+    (("720p", "HD"), "720p"),
+    (("480p", "SD"), "480p"),
+    (("360p", "LD"), "360p")
 ]
 
-LANGUAGE_PATTERNS = [
-    (re.compile(r'\b(English|ENG|en)\b', re.IGNORECASE), "English"),
-    (re.compile(r'\b(Hindi|HIN|hi)\b', re.IGNORECASE), "Hindi"),
-    (re.compile(r'\b(Tamil|TAM|ta)\b', re.IGNORECASE), "Tamil"),
-    (re.compile(r'\b(Telugu|TEL|te)\b', re.IGNORECASE), "Telugu"),
-    (re.compile(r'\b(Malayalam|MAL|ml)\b', re.IGNORECASE), "Malayalam"),
-    (re.compile(r'\b(Kannada|KAN|kn)\b', re.IGNORECASE), "Kannada"),
-    (re.compile(r'\b(Bengali|BEN|bn)\b', re.IGNORECASE), "Bengali"),
-    (re.compile(r'\b(Marathi|MAR|mr)\b', re.IGNORECASE), "Marathi"),
-    (re.compile(r'\b(Gujarati|GUJ|gu)\b', re.IGNORECASE), "Gujarati"),
-    (re.compile(r'\b(Punjabi|PUN|pa)\b', re.IGNORECASE), "Punjabi")
+LANGUAGE_WORDS = [
+    (("English", "ENG", "en"), "English"),
+    (("Hindi", "HIN", "hi"), "Hindi"),
+    (("Tamil", "TAM", "ta"), "Tamil"),
+    (("Telugu", "TEL", "te"), "Telugu"),
+    (("Malayalam", "MAL", "ml"), "Malayalam"),
+    (("Kannada", "KAN", "kn"), "Kannada"),
+    (("Bengali", "BEN", "bn"), "Bengali"),
+    (("Marathi", "MAR", "mr"), "Marathi"),
+    (("Gujarati", "GUJ", "gu"), "Gujarati"),
+    (("Punjabi", "PUN", "pa"), "Punjabi")
 ]
 
+WORD_PATTERN = re.compile(r'\w+')
+
+# Pre-compiled regex patterns for better performance
+
 EPISODE_PATTERNS = [
     re.compile(r'\b(?:EP|E)\s*-\s*(\d{1,3})\b', re.IGNORECASE),
     re.compile(r'\b(?:EP|E)\s*(\d{1,3})\b', re.IGNORECASE),
@@ -53,9 +164,267 @@ SEASON_PATTERNS = [
     re.compile(r'S(\d+)\s', re.IGNORECASE)
 ]
 
+@lru_cache(maxsize=1024)
+def filename_tokens(filename):
+    """Lowercased words of a filename, shared by the quality and language lookups"""
+    return tuple(WORD_PATTERN.findall(filename.lower()))
+
+class WordClassifier:
+    """Finds the highest priority tag among a filename's words with one tokenization.
+
+    Same result as searching each r'\b(word|...)\b' pattern in priority order.
+    """
+    def __init__(self, table, default):
+        self.labels = [label for _, label in table]
+        self.index = {}
+        for priority, (words, _) in enumerate(table):
+            for word in words:
+                self.index.setdefault(word.lower(), priority)
+        self.default = default
+
+    def classify(self, filename):
+        best = None
+        for token in filename_tokens(filename):
+            priority = self.index.get(token)
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if priority == 0:
+                    break
+        return self.labels[best] if best is not None else self.default
+
+QUALITY_CLASSIFIER = WordClassifier(QUALITY_WORDS, "HD")
+LANGUAGE_CLASSIFIER = WordClassifier(LANGUAGE_WORDS, "Multi")
+
 # Custom button pattern
 BUTTON_PATTERN = re.compile(r'\[(.*?)\]\[buttonurl:(.*?)\]')
 
+# Caption placeholders: {field}, {field|default} and {#field}...{/field} sections
+TEMPLATE_TOKEN_PATTERN = re.compile(
+    r'\{([#/]?)(filename|episode|season|quality|language|filesize)(?:\|([^{}]*))?\}'
+)
+
+BLANK_LINES_PATTERN = re.compile(r'\n\s*\n')
+
+MISSING = object()
+
+class TTLCache:
+    """Bounded LRU mapping with optional expiry; None is a valid cached value"""
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+class TokenBucket:
+    """Async rate limiter: `rate` tokens per second, bursts of up to `capacity`"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        """Take a token without waiting; 0 if one was taken, else seconds until one is free"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Hold every caller for `seconds`, e.g. for a FloodWait"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # Refill from empty once the pause ends, not with the pause's worth of tokens
+        self.tokens = 0
+        self.updated = self.paused_until
+
+class RecentMessages:
+    """Bounded record of the latest message ids handled in each chat"""
+    def __init__(self, per_chat, chats):
+        self.per_chat = per_chat
+        self.chats = TTLCache(chats)
+        self.duplicates = 0
+
+    def add(self, chat_id, message_id):
+        """Record a message; False if it was already recorded"""
+        entry = self.chats.get(chat_id)
+        if entry is MISSING:
+            entry = (deque(), set())
+            self.chats.set(chat_id, entry)
+        order, seen = entry
+        if message_id in seen:
+            self.duplicates += 1
+            return False
+        order.append(message_id)
+        seen.add(message_id)
+        if len(order) > self.per_chat:
+            seen.discard(order.popleft())
+        return True
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class Histogram:
+    """Latency histogram with fixed bucket bounds in seconds, Prometheus style"""
+    BOUNDS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate by interpolating inside the bucket that holds the q-th observation"""
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+class Metrics:
+    """Stage latencies and error counts of the auto-caption pipeline"""
+    # Pipeline order, used for /stats and the Prometheus output
+    STAGES = ("config", "job_store", "queue", "parse", "render", "text_settings", "buttons", "rate_limit", "edit")
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in self.STAGES}
+        self.errors = {}
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage].observe(time.perf_counter() - started)
+
+    def error(self, error):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+metrics = Metrics()
+
+class StatsCounters:
+    """Totals behind /stats, kept current by the managers and reconciled with Mongo now and then"""
+    SECTIONS = ("caption", "text_settings", "button")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(("users",) + self.SECTIONS, 0)
+        self.started = time.monotonic()
+        self.reconciled_at = None
+        self.task = None
+
+    def add(self, name, count=1):
+        if name in self.counts:
+            self.counts[name] += count
+
+    async def reconcile(self):
+        """Recount from Mongo: the users estimate comes from collection metadata, the sections from one scan"""
+        users = await users_collection.estimated_document_count()
+        group = {"_id": None}
+        for section in self.SECTIONS:
+            group[section] = {"$sum": {"$cond": [{"$ifNull": [f"${section}", False]}, 1, 0]}}
+        totals = await configs_collection.aggregate([{"$group": group}]).to_list(1)
+        self.counts["users"] = users
+        for section in self.SECTIONS:
+            self.counts[section] = totals[0][section] if totals else 0
+        self.reconciled_at = time.monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception:
+                log.exception("Stats reconciliation failed", extra={"stage": "stats"})
+            await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+bot_stats = StatsCounters()
+
+config_cache = TTLCache(CONFIG_CACHE_SIZE, CONFIG_CACHE_TTL)
+# (filename, file_size) -> FileInfo, so files forwarded to many channels are parsed once
+file_info_cache = TTLCache(FILE_INFO_CACHE_SIZE)
+
 class FileInfoExtractor:
     @staticmethod
     def extract_episode(filename):
@@ -75,17 +444,11 @@ class FileInfoExtractor:
 
     @staticmethod
     def extract_quality(filename):
-        for pattern, quality in QUALITY_PATTERNS:
-            if pattern.search(filename):
-                return quality
-        return "HD"
+        return QUALITY_CLASSIFIER.classify(filename)
 
     @staticmethod
     def extract_language(filename):
-        for pattern, language in LANGUAGE_PATTERNS:
-            if pattern.search(filename):
-                return language
-        return "Multi"
+        return LANGUAGE_CLASSIFIER.classify(filename)
 
     @staticmethod
     def format_file_size(size_bytes):
@@ -99,176 +462,1058 @@ class FileInfoExtractor:
         return f"{size_bytes:.2f} TB"
 
     @staticmethod
-    def extract_all_info(filename, file_size):
-        return {
-            'filename': filename,
-            'episode': FileInfoExtractor.extract_episode(filename),
-            'season': FileInfoExtractor.extract_season(filename),
-            'quality': FileInfoExtractor.extract_quality(filename),
-            'language': FileInfoExtractor.extract_language(filename),
-            'filesize': FileInfoExtractor.format_file_size(file_size)
-        }
+    def extract_info(filename, file_size):
+        """Lazy file info: each field is parsed only when a caption uses it"""
+        key = (filename, file_size)
+        info = file_info_cache.get(key)
+        if info is MISSING:
+            info = FileInfo(filename, file_size)
+            file_info_cache.set(key, info)
+        return info
 
-class TextSettingsManager:
+FILE_INFO_FIELDS = {
+    'filename': lambda filename, file_size: filename,
+    'episode': lambda filename, file_size: FileInfoExtractor.extract_episode(filename),
+    'season': lambda filename, file_size: FileInfoExtractor.extract_season(filename),
+    'quality': lambda filename, file_size: FileInfoExtractor.extract_quality(filename),
+    'language': lambda filename, file_size: FileInfoExtractor.extract_language(filename),
+    'filesize': lambda filename, file_size: FileInfoExtractor.format_file_size(file_size)
+}
+
+class FileInfo:
+    """Mapping of file info fields computed on first access"""
+    __slots__ = ('filename', 'file_size', 'parse_seconds', '_values')
+
+    def __init__(self, filename, file_size):
+        self.filename = filename
+        self.file_size = file_size
+        # Time spent computing fields, so callers can separate parsing from rendering
+        self.parse_seconds = 0.0
+        self._values = {}
+
+    def __getitem__(self, field):
+        try:
+            return self._values[field]
+        except KeyError:
+            started = time.perf_counter()
+            value = self._values[field] = FILE_INFO_FIELDS[field](self.filename, self.file_size)
+            self.parse_seconds += time.perf_counter() - started
+            return value
+
+class ChannelConfigManager:
+    """Per-chat configuration: one document holding the caption, text_settings and button sections"""
     @staticmethod
-    async def add_remove_text(chat_id, text_to_remove, user_id, username):
-        text_settings_collection.update_one(
-            {"chat_id": chat_id},
-            {"$addToSet": {"remove_texts": text_to_remove},
-             "$set": {"user_id": user_id, "username": username}},
-            upsert=True
+    def legacy_sections():
+        # Looked up when called, so swapped-in collections (benchmarks/replay.py) are used
+        return (
+            ("caption", channels_collection),
+            ("text_settings", text_settings_collection),
+            ("button", button_collection)
         )
 
+    # chat_id -> in-flight load, so a burst of posts shares one query
+    _loads = {}
+
     @staticmethod
-    async def add_replace_text(chat_id, old_text, new_text, user_id, username):
-        text_settings_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {f"replace_texts.{old_text}": new_text,
-                     "user_id": user_id, "username": username}},
-            upsert=True
-        )
+    async def get_config(chat_id):
+        """Cached read; chats without a config are cached as None too"""
+        config = config_cache.get(chat_id)
+        if config is not MISSING:
+            return config
+
+        load = ChannelConfigManager._loads.get(chat_id)
+        if load is None:
+            load = asyncio.ensure_future(ChannelConfigManager._load_config(chat_id))
+            ChannelConfigManager._loads[chat_id] = load
+        return await asyncio.shield(load)
 
     @staticmethod
-    async def get_text_settings(chat_id):
-        return text_settings_collection.find_one({"chat_id": chat_id})
+    async def _load_config(chat_id):
+        try:
+            config = await configs_collection.find_one({"chat_id": chat_id})
+        finally:
+            is_current = ChannelConfigManager._loads.get(chat_id) is asyncio.current_task()
+            if is_current:
+                del ChannelConfigManager._loads[chat_id]
+        # A write that landed while we were loading invalidated this result
+        if is_current:
+            config_cache.set(chat_id, config)
+        return config
 
     @staticmethod
-    async def remove_text_setting(chat_id, text_type, text_value, user_id):
-        settings = text_settings_collection.find_one({"chat_id": chat_id})
-        if not settings or settings.get("user_id") != user_id:
-            return False
+    def derived(config, name, build):
+        """Memoize an object built from a cached config until the chat's config changes"""
+        key = f"_{name}"
+        value = config.get(key, MISSING)
+        if value is MISSING:
+            value = config[key] = build()
+        return value
 
-        if text_type == "remove":
-            result = text_settings_collection.update_one(
-                {"chat_id": chat_id},
-                {"$pull": {"remove_texts": text_value}}
+    @staticmethod
+    def invalidate(chat_id):
+        config_cache.pop(chat_id)
+        ChannelConfigManager._loads.pop(chat_id, None)
+
+    @staticmethod
+    async def get_section(chat_id, section):
+        config = await ChannelConfigManager.get_config(chat_id)
+        return config.get(section) if config else None
+
+    @staticmethod
+    async def set_fields(chat_id, update):
+        sections = {field.split(".")[0] for fields in update.values() for field in fields}
+        try:
+            # The document as it was tells which sections this update creates
+            before = await configs_collection.find_one_and_update(
+                {"chat_id": chat_id}, update,
+                projection=dict.fromkeys(sections, 1),
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
             )
-        elif text_type == "replace":
-            result = text_settings_collection.update_one(
-                {"chat_id": chat_id},
-                {"$unset": {f"replace_texts.{text_value}": ""}}
+        finally:
+            ChannelConfigManager.invalidate(chat_id)
+        for section in sections:
+            if not before or section not in before:
+                bot_stats.add(section)
+
+    @staticmethod
+    async def update_owned(chat_id, section, user_id, update):
+        """Apply update only if the section was set by user_id"""
+        try:
+            result = await configs_collection.update_one(
+                {"chat_id": chat_id, f"{section}.user_id": user_id},
+                update
             )
-        
+        finally:
+            ChannelConfigManager.invalidate(chat_id)
+        if result.modified_count and section in update.get("$unset", {}):
+            bot_stats.add(section, -1)
         return result.modified_count > 0
 
     @staticmethod
-    async def clear_all_settings(chat_id, user_id):
-        settings = text_settings_collection.find_one({"chat_id": chat_id})
-        if settings and settings.get("user_id") == user_id:
-            result = text_settings_collection.delete_one({"chat_id": chat_id})
-            return result.deleted_count > 0
-        return False
+    async def migrate_legacy_collections():
+        """Move documents from the old per-feature collections into channel_configs"""
+        for section, collection in ChannelConfigManager.legacy_sections():
+            async for doc in collection.find({}):
+                legacy_id = doc.pop("_id")
+                chat_id = doc.pop("chat_id", None)
+                if chat_id is not None:
+                    await configs_collection.update_one(
+                        {"chat_id": chat_id},
+                        {"$set": {section: doc}},
+                        upsert=True
+                    )
+                await collection.delete_one({"_id": legacy_id})
 
+class SchemaManager:
+    """Indexes the hot queries rely on, created at startup, and a check that Mongo actually uses them"""
+    # Collections are looked up when called, like legacy_sections()
     @staticmethod
-    def apply_text_settings(caption, settings):
-        if not settings:
-            return caption
+    def unique_keys():
+        return ((configs_collection, "chat_id"), (users_collection, "user_id"))
 
-        # Apply remove text
-        if 'remove_texts' in settings:
-            for text_to_remove in settings['remove_texts']:
-                caption = caption.replace(text_to_remove, '')
+    @staticmethod
+    def secondary_indexes():
+        return (
+            # /mycaptions pages through a user's captions in _id order
+            (configs_collection, [("caption.user_id", 1), ("_id", 1)]),
+        )
 
-        # Apply replace text
-        if 'replace_texts' in settings:
-            for old_text, new_text in settings['replace_texts'].items():
-                caption = caption.replace(old_text, new_text)
+    @staticmethod
+    def hot_queries():
+        """(name, collection, filter, sort) of the queries that must be index-backed"""
+        return (
+            ("config by chat", configs_collection, {"chat_id": 0}, None),
+            ("owned section update", configs_collection, {"chat_id": 0, "caption.user_id": 0}, None),
+            ("captions by owner", configs_collection, {"caption.user_id": 0}, [("_id", 1)]),
+            ("user by id", users_collection, {"user_id": 0}, None)
+        )
 
-        # Clean up extra spaces and newlines
-        caption = re.sub(r'\n\s*\n', '\n\n', caption)  # Remove extra blank lines
-        caption = caption.strip()
-        
+    @staticmethod
+    async def bootstrap():
+        for collection, key in SchemaManager.unique_keys():
+            try:
+                indexes = await collection.index_information()
+                if any(info.get("unique") and list(info["key"]) == [(key, 1)] for info in indexes.values()):
+                    continue
+                # Without the index, racing upserts may have inserted the same key twice
+                removed = await SchemaManager.dedupe(collection, key)
+                if removed:
+                    log.warning("Merged %d duplicate %s documents by %s", removed, collection.name, key)
+                await collection.create_index(key, unique=True)
+            except Exception:
+                log.exception("Could not create the unique %s index on %s", key, collection.name)
+
+        for collection, keys in SchemaManager.secondary_indexes():
+            try:
+                await collection.create_index(keys)
+            except Exception:
+                log.exception("Could not create index %s on %s", keys, collection.name)
+
+        await SchemaManager.verify()
+
+    @staticmethod
+    async def dedupe(collection, key):
+        """Fold documents sharing `key` into the oldest one, later fields winning; returns how many were removed"""
+        removed = 0
+        groups = collection.aggregate([
+            {"$group": {"_id": f"${key}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}, "_id": {"$ne": None}}}
+        ], allowDiskUse=True)
+        async for group in groups:
+            docs = await collection.find({"_id": {"$in": group["ids"]}}).sort("_id", 1).to_list(None)
+            merged = {}
+            for doc in docs:
+                merged.update(doc)
+            merged["_id"] = docs[0]["_id"]
+            await collection.replace_one({"_id": merged["_id"]}, merged)
+            result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs[1:]]}})
+            removed += result.deleted_count
+        return removed
+
+    @staticmethod
+    def plan_stages(plan):
+        """Every stage name in an explain() plan tree"""
+        stages = set()
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                stages.add(plan["stage"])
+            for value in plan.values():
+                stages |= SchemaManager.plan_stages(value)
+        elif isinstance(plan, list):
+            for item in plan:
+                stages |= SchemaManager.plan_stages(item)
+        return stages
+
+    @staticmethod
+    async def verify():
+        for name, collection, query, sort in SchemaManager.hot_queries():
+            cursor = collection.find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                explain = await cursor.explain()
+            except Exception:
+                log.exception("Could not explain the %s query", name)
+                continue
+            stages = SchemaManager.plan_stages(explain.get("queryPlanner", {}).get("winningPlan"))
+            if "COLLSCAN" in stages:
+                log.warning("The %s query is not index-backed: %s", name, ", ".join(sorted(stages)))
+            else:
+                log.debug("The %s query plan: %s", name, ", ".join(sorted(stages)))
+
+class TextRules:
+    """A chat's remove/replace rules compiled into one prefix-factored regex.
+
+    Rules apply removals first, then replacements, each over the whole caption.
+    A caption is rewritten in one pass unless a match could interact with
+    another rule, in which case the rules are applied one by one as before.
+    """
+    # Below this many rules the str.replace loop is faster than one regex
+    # pass with its per-match checks (benchmarks/text_rules.py)
+    COMPILE_MIN_RULES = 32
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.outputs = {}
+        self.order = {}
+        for index, (old_text, new_text) in enumerate(rules):
+            self.outputs.setdefault(old_text, new_text)
+            self.order.setdefault(old_text, index)
+
+        self.pattern = None
+        self.single_pass = bool(rules) and len(rules) >= self.COMPILE_MIN_RULES and self._independent(rules)
+        if self.single_pass:
+            self.pattern = re.compile(self._trie_pattern(list(self.outputs)))
+            self.partners = {
+                old_text: [other for other in self.outputs if self._overlaps(old_text, other)]
+                for old_text in self.outputs
+            }
+            # Character pairs a later rule would need to find across a substitution edge
+            self.later_pairs = []
+            pairs = set()
+            for old_text, _ in reversed(rules):
+                self.later_pairs.append(frozenset(pairs))
+                pairs.update(old_text[i:i + 2] for i in range(len(old_text) - 1))
+            self.later_pairs.reverse()
+
+    @classmethod
+    def from_settings(cls, settings):
+        rules = [(text, '') for text in settings.get('remove_texts') or []]
+        rules += list((settings.get('replace_texts') or {}).items())
+        return cls(rules)
+
+    @staticmethod
+    def _trie_pattern(texts):
+        """Alternation factored by common prefixes, so each position is tried once per branch"""
+        trie = {}
+        for text in texts:
+            node = trie
+            for char in text:
+                node = node.setdefault(char, {})
+            node[''] = None
+
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in node.items() if char]
+            if not branches:
+                return ''
+            body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            # Shorter texts ending here still match when the longer ones do not
+            if '' in node:
+                return '(?:' + body + ')?'
+            return body
+
+        return build(trie)
+
+    @staticmethod
+    def _overlaps(first, second):
+        """True if occurrences of the two texts can partially overlap"""
+        if first != second and (first in second or second in first):
+            return True
+        return any(
+            first.endswith(second[:size]) or second.endswith(first[:size])
+            for size in range(1, min(len(first), len(second)))
+        )
+
+    @staticmethod
+    def _independent(rules):
+        for index, (old_text, new_text) in enumerate(rules):
+            if not old_text:
+                return False
+            if any(later_text in new_text for later_text, _ in rules[index + 1:]):
+                return False
+        return True
+
+    def _overlapped(self, caption, start, end, old_text):
+        for other in self.partners[old_text]:
+            index = caption.find(other, max(0, start - len(other) + 1), end + len(other) - 1)
+            while index != -1:
+                if index != start or other != old_text:
+                    return True
+                index = caption.find(other, index + 1, end + len(other) - 1)
+        return False
+
+    def _apply_sequential(self, caption):
+        for old_text, new_text in self.rules:
+            caption = caption.replace(old_text, new_text)
         return caption
 
+    def _apply_single_pass(self, caption):
+        parts = []
+        position = 0
+        for match in self.pattern.finditer(caption):
+            start, end = match.span()
+            old_text = match.group()
+            new_text = self.outputs[old_text]
+            pairs = self.later_pairs[self.order[old_text]]
+
+            # Fall back whenever a later rule could see different text than
+            # this single pass: adjacent or overlapping matches, or a match
+            # that joins characters a later rule contains
+            if parts and start == position:
+                return self._apply_sequential(caption)
+            if self.partners[old_text] and self._overlapped(caption, start, end, old_text):
+                return self._apply_sequential(caption)
+            if pairs:
+                before = caption[start - 1:start]
+                after = caption[end:end + 1]
+                if new_text:
+                    joined = before + new_text[0] in pairs or new_text[-1] + after in pairs
+                else:
+                    joined = before + after in pairs
+                if joined:
+                    return self._apply_sequential(caption)
+
+            parts.append(caption[position:start])
+            parts.append(new_text)
+            position = end
+
+        if not parts:
+            return caption
+        parts.append(caption[position:])
+        return ''.join(parts)
+
+    def apply(self, caption):
+        if self.single_pass:
+            caption = self._apply_single_pass(caption)
+        elif self.rules:
+            caption = self._apply_sequential(caption)
+
+        # Clean up extra spaces and newlines
+        caption = BLANK_LINES_PATTERN.sub('\n\n', caption)  # Remove extra blank lines
+        return caption.strip()
+
+class TextSettingsManager:
+    @staticmethod
+    async def add_remove_text(chat_id, text_to_remove, user_id, username):
+        await ChannelConfigManager.set_fields(chat_id, {
+            "$addToSet": {"text_settings.remove_texts": text_to_remove},
+            "$set": {"text_settings.user_id": user_id, "text_settings.username": username}
+        })
+
+    @staticmethod
+    async def add_replace_text(chat_id, old_text, new_text, user_id, username):
+        await ChannelConfigManager.set_fields(chat_id, {
+            "$set": {f"text_settings.replace_texts.{old_text}": new_text,
+                     "text_settings.user_id": user_id, "text_settings.username": username}
+        })
+
+    @staticmethod
+    async def get_text_settings(chat_id):
+        return await ChannelConfigManager.get_section(chat_id, "text_settings")
+
+    @staticmethod
+    async def remove_text_setting(chat_id, text_type, text_value, user_id):
+        if text_type == "remove":
+            update = {"$pull": {"text_settings.remove_texts": text_value}}
+        elif text_type == "replace":
+            update = {"$unset": {f"text_settings.replace_texts.{text_value}": ""}}
+        else:
+            return False
+
+        return await ChannelConfigManager.update_owned(chat_id, "text_settings", user_id, update)
+
+    @staticmethod
+    async def clear_all_settings(chat_id, user_id):
+        return await ChannelConfigManager.update_owned(
+            chat_id, "text_settings", user_id, {"$unset": {"text_settings": ""}}
+        )
+
+    @staticmethod
+    def get_rules(config):
+        """Compiled text rules, kept on the cached config of the chat"""
+        return ChannelConfigManager.derived(
+            config, "text_rules",
+            lambda: TextRules.from_settings(config["text_settings"])
+        )
+
 class ButtonManager:
+    @staticmethod
+    def parse_button_rows(button_text):
+        """Parse button format into [text, url] pairs: [Text][buttonurl:https://example.com]"""
+        return [
+            [text.strip(), url.strip()]
+            for text, url in BUTTON_PATTERN.findall(button_text)
+            if url.startswith(('http://', 'https://', 't.me/'))
+        ]
+
+    @staticmethod
+    def build_markup(rows):
+        buttons = [[InlineKeyboardButton(text, url=url)] for text, url in rows]
+        return InlineKeyboardMarkup(buttons) if buttons else None
+
     @staticmethod
     def parse_buttons(button_text):
         """Parse button format: [Text][buttonurl:https://example.com]"""
-        buttons = []
-        matches = BUTTON_PATTERN.findall(button_text)
-        
-        for text, url in matches:
-            if url.startswith(('http://', 'https://', 't.me/')):
-                buttons.append([InlineKeyboardButton(text.strip(), url=url.strip())])
-        
-        return InlineKeyboardMarkup(buttons) if buttons else None
+        return ButtonManager.build_markup(ButtonManager.parse_button_rows(button_text))
+
+    @staticmethod
+    def get_markup(config):
+        """Reply markup built once per chat and reused until /setbutton or /removebutton"""
+        def build():
+            button_data = config.get("button")
+            if not button_data:
+                return None
+            rows = button_data.get("parsed_buttons")
+            # Buttons saved before rows were stored only kept a flag here
+            if not isinstance(rows, list):
+                rows = ButtonManager.parse_button_rows(button_data.get("button_text", ""))
+            return ButtonManager.build_markup(rows)
+
+        return ChannelConfigManager.derived(config, "markup", build)
 
     @staticmethod
     async def set_custom_button(chat_id, button_text, user_id, username):
-        button_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {
+        await ChannelConfigManager.set_fields(chat_id, {
+            "$set": {"button": {
                 "button_text": button_text,
                 "user_id": user_id,
                 "username": username,
-                "parsed_buttons": ButtonManager.parse_buttons(button_text) is not None
-            }},
-            upsert=True
-        )
+                "parsed_buttons": ButtonManager.parse_button_rows(button_text)
+            }}
+        })
 
     @staticmethod
     async def get_custom_button(chat_id):
-        return button_collection.find_one({"chat_id": chat_id})
+        return await ChannelConfigManager.get_section(chat_id, "button")
 
     @staticmethod
     async def remove_custom_button(chat_id, user_id):
-        button_data = button_collection.find_one({"chat_id": chat_id})
-        if button_data and button_data.get("user_id") == user_id:
-            result = button_collection.delete_one({"chat_id": chat_id})
-            return result.deleted_count > 0
-        return False
+        return await ChannelConfigManager.update_owned(
+            chat_id, "button", user_id, {"$unset": {"button": ""}}
+        )
 
     @staticmethod
     async def clear_all_buttons(chat_id, user_id):
-        button_data = button_collection.find_one({"chat_id": chat_id})
-        if button_data and button_data.get("user_id") == user_id:
-            result = button_collection.delete_one({"chat_id": chat_id})
-            return result.deleted_count > 0
-        return False
+        return await ButtonManager.remove_custom_button(chat_id, user_id)
+
+class CaptionTemplate:
+    """Caption template compiled once into literal, field and section nodes"""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    @staticmethod
+    def _append_literal(nodes, text):
+        if not text:
+            return
+        if nodes and isinstance(nodes[-1], str):
+            nodes[-1] += text
+        else:
+            nodes.append(text)
+
+    @classmethod
+    def compile(cls, template):
+        root = []
+        # Open sections as (field, opening token, parent nodes, own nodes)
+        stack = []
+        nodes = root
+        position = 0
+
+        for match in TEMPLATE_TOKEN_PATTERN.finditer(template):
+            cls._append_literal(nodes, template[position:match.start()])
+            position = match.end()
+            marker, field, default = match.groups()
+
+            if marker == '#':
+                stack.append((field, match.group(0), nodes, []))
+                nodes = stack[-1][3]
+            elif marker == '/':
+                if stack and stack[-1][0] == field:
+                    field, _, parent, children = stack.pop()
+                    parent.append(('section', field, children))
+                    nodes = parent
+                else:
+                    cls._append_literal(nodes, match.group(0))
+            else:
+                nodes.append(('field', field, default))
+
+        cls._append_literal(nodes, template[position:])
+
+        # Unclosed sections are kept as plain text
+        while stack:
+            _, token, parent, children = stack.pop()
+            cls._append_literal(parent, token)
+            for node in children:
+                if isinstance(node, str):
+                    cls._append_literal(parent, node)
+                else:
+                    parent.append(node)
+
+        return cls(root)
+
+    @staticmethod
+    def _value(file_info, field):
+        value = file_info[field]
+        return str(value) if value else None
+
+    def _render(self, nodes, file_info, out):
+        for node in nodes:
+            if isinstance(node, str):
+                out.append(node)
+            elif node[0] == 'field':
+                value = self._value(file_info, node[1])
+                if value is None:
+                    value = node[2] if node[2] is not None else 'N/A'
+                out.append(value)
+            elif self._value(file_info, node[1]) is not None:
+                self._render(node[2], file_info, out)
+
+    def render(self, file_info):
+        out = []
+        self._render(self.nodes, file_info, out)
+        return ''.join(out)
+
+@lru_cache(maxsize=1024)
+def compile_caption_template(template):
+    return CaptionTemplate.compile(template)
 
 class CaptionManager:
+    # Characters of each caption /mycaptions shows
+    PREVIEW_LENGTH = 50
+
     @staticmethod
     async def set_caption(chat_id, caption_text, chat_title, user_id, username):
-        channels_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {
+        compile_caption_template(caption_text)
+        await ChannelConfigManager.set_fields(chat_id, {
+            "$set": {"caption": {
                 "caption": caption_text, 
                 "chat_title": chat_title,
                 "user_id": user_id,
                 "username": username
-            }},
-            upsert=True
-        )
+            }}
+        })
 
     @staticmethod
     async def remove_caption(chat_id, user_id):
-        caption_data = channels_collection.find_one({"chat_id": chat_id})
-        if caption_data and caption_data.get("user_id") == user_id:
-            result = channels_collection.delete_one({"chat_id": chat_id})
-            return result.deleted_count > 0
-        return False
+        return await ChannelConfigManager.update_owned(
+            chat_id, "caption", user_id, {"$unset": {"caption": ""}}
+        )
 
     @staticmethod
     async def get_caption(chat_id):
-        return channels_collection.find_one({"chat_id": chat_id})
+        return await ChannelConfigManager.get_section(chat_id, "caption")
+
+    @staticmethod
+    async def list_captions(user_id, anchor=None, backwards=False, limit=MYCAPTIONS_PAGE_SIZE):
+        """One page of a user's captions in _id order after (or before) `anchor`, and whether more follow"""
+        query = {"caption.user_id": user_id}
+        if anchor:
+            query["_id"] = {"$lt" if backwards else "$gt": anchor}
+        # Only the title and a preview leave the server
+        projection = {
+            "chat_title": "$caption.chat_title",
+            "preview": {"$substrCP": ["$caption.caption", 0, CaptionManager.PREVIEW_LENGTH]},
+            "truncated": {"$gt": [{"$strLenCP": "$caption.caption"}, CaptionManager.PREVIEW_LENGTH]}
+        }
+        cursor = configs_collection.find(query, projection).sort("_id", -1 if backwards else 1).limit(limit + 1)
+        docs = await cursor.to_list(limit + 1)
+        more = len(docs) > limit
+        docs = docs[:limit]
+        if backwards:
+            docs.reverse()
+        return docs, more
+
+    @staticmethod
+    def get_template(config):
+        """Compiled caption template, kept on the cached config of the chat"""
+        return ChannelConfigManager.derived(
+            config, "template",
+            lambda: compile_caption_template(config["caption"]["caption"])
+        )
 
     @staticmethod
     def format_caption(caption_template, file_info):
         """Format caption with all placeholders"""
-        caption = caption_template
-        placeholders = {
-            '{filename}': file_info['filename'],
-            '{episode}': str(file_info['episode']) if file_info['episode'] else 'N/A',
-            '{season}': str(file_info['season']) if file_info['season'] else 'N/A',
-            '{quality}': file_info['quality'],
-            '{language}': file_info['language'],
-            '{filesize}': file_info['filesize']
-        }
-        
-        for placeholder, value in placeholders.items():
-            caption = caption.replace(placeholder, value)
-        
-        return caption
+        return compile_caption_template(caption_template).render(file_info)
+
+class Broadcaster:
+    """Sends one text to every tracked user from a worker pool under a shared rate limit"""
+    PROGRESS_INTERVAL = 5
+    BLOCKED_ERRORS = (UserIsBlocked, InputUserDeactivated, PeerIdInvalid)
+
+    def __init__(self, client, text, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE):
+        self.client = client
+        self.text = text
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.queue = asyncio.Queue(maxsize=workers * 4)
+        self.total = 0
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def done(self):
+        return self.sent + self.blocked + self.failed
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        speed = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / speed if speed else 0
+        return (
+            f"📤 **Sent:** {self.sent}\n"
+            f"🚫 **Blocked:** {self.blocked}\n"
+            f"❌ **Failed:** {self.failed}\n"
+            f"📊 **Progress:** {self.done}/{self.total} ({speed:.1f} msgs/s)\n"
+            f"⏳ **ETA:** {format_duration(max(eta, 0))}"
+        )
+
+    async def _send(self, user_id):
+        for attempt in range(BROADCAST_RETRIES):
+            await self.bucket.acquire()
+            try:
+                await self.client.send_message(user_id, self.text)
+                return "sent"
+            except FloodWait as e:
+                self.bucket.pause(e.value)
+            except self.BLOCKED_ERRORS:
+                return "blocked"
+            except TRANSIENT_ERRORS:
+                await asyncio.sleep(2 ** attempt)
+            except RPCError:
+                return "failed"
+            except Exception as e:
+                # One bad recipient must not take a worker down with it
+                metrics.error(e)
+                log.exception("Broadcast send failed", extra={"chat_id": user_id, "stage": "broadcast"})
+                return "failed"
+        return "failed"
+
+    async def _worker(self):
+        while True:
+            user_id = await self.queue.get()
+            if user_id is None:
+                return
+            result = await self._send(user_id)
+            setattr(self, result, getattr(self, result) + 1)
+
+    async def _report(self, progress_message):
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            try:
+                await progress_message.edit_text("📣 **Broadcasting...**\n\n" + self.summary())
+            except RPCError as e:
+                log.debug("Broadcast progress update failed: %r", e)
+
+    async def run(self, progress_message):
+        self.total = await users_collection.estimated_document_count()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report(progress_message))
+        try:
+            async for user in users_collection.find({}, {"user_id": 1}):
+                await self.queue.put(user["user_id"])
+            for _ in workers:
+                await self.queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+        self.total = self.done
+
+class SlowCallbackLog(logging.Handler):
+    """Keeps the slow-callback warnings asyncio logs in debug mode"""
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+class Profiler:
+    """cProfile plus event-loop lag and slow callbacks over one time window.
+    Nothing is hooked into the loop outside start()/stop(), so it costs nothing when off."""
+    LAG_INTERVAL = 0.05
+    running = False
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.profile = cProfile.Profile()
+        self.lag = Histogram()
+        self.slow_callbacks = SlowCallbackLog()
+        self.watcher = None
+        self.loop_settings = None
+
+    async def _watch_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.lag.observe(max(0.0, loop.time() - started - self.LAG_INTERVAL))
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        Profiler.running = True
+        self.loop_settings = (loop.get_debug(), loop.slow_callback_duration)
+        # Debug mode makes asyncio log every callback slower than slow_callback_duration
+        loop.set_debug(True)
+        loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+        logging.getLogger("asyncio").addHandler(self.slow_callbacks)
+        self.watcher = asyncio.create_task(self._watch_lag())
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.watcher.cancel()
+        logging.getLogger("asyncio").removeHandler(self.slow_callbacks)
+        loop = asyncio.get_running_loop()
+        debug, loop.slow_callback_duration = self.loop_settings
+        loop.set_debug(debug)
+        Profiler.running = False
+
+    def summary(self):
+        return (
+            f"🔬 **Profile:** {self.seconds}s\n"
+            f"⏱️ **Loop lag:** p50 {self.lag.quantile(0.5) * 1000:.1f}ms, "
+            f"p99 {self.lag.quantile(0.99) * 1000:.1f}ms, max {self.lag.max * 1000:.1f}ms\n"
+            f"🐢 **Slow callbacks:** {len(self.slow_callbacks.records)}"
+        )
+
+    def report(self):
+        out = io.StringIO()
+        out.write(f"Profile window: {self.seconds}s\n\n")
+        out.write(f"Event loop lag ({self.lag.count} samples every {self.LAG_INTERVAL * 1000:.0f}ms)\n")
+        if self.lag.count:
+            out.write(
+                f"  mean {self.lag.sum / self.lag.count * 1000:.2f}ms  "
+                f"p50 {self.lag.quantile(0.5) * 1000:.2f}ms  p99 {self.lag.quantile(0.99) * 1000:.2f}ms  "
+                f"max {self.lag.max * 1000:.2f}ms\n"
+            )
+        out.write(f"\nSlow callbacks (> {PROFILE_SLOW_CALLBACK * 1000:.0f}ms): {len(self.slow_callbacks.records)}\n")
+        for record in self.slow_callbacks.records:
+            out.write(f"  {record}\n")
+        out.write(f"\nTop {PROFILE_TOP} functions by cumulative time\n")
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return out.getvalue()
+
+class RetryLater(Exception):
+    """Raised by a dispatched job that can't go ahead yet; its chat is retried after `delay` seconds"""
+    def __init__(self, delay):
+        super().__init__(delay)
+        self.delay = delay
+
+class ChatDispatcher:
+    """Runs jobs in FIFO order per chat while different chats are processed in parallel.
+
+    Chats with pending work take turns one job at a time, so a large upload in
+    one channel cannot starve the others. A throttled chat is set aside until
+    its wait is over instead of holding a worker.
+    """
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self.workers = workers
+        # chat_id -> deque of jobs; a chat is in `ready`, deferred or being
+        # worked on exactly while it has an entry here
+        self.queues = {}
+        self.ready = asyncio.Queue()
+        # chat_id -> timer that puts a throttled chat back in `ready`
+        self.deferred = {}
+        self.pending = 0
+        self.empty = asyncio.Event()
+        self.empty.set()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for timer in self.deferred.values():
+            timer.cancel()
+        self.deferred.clear()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def drain(self, timeout):
+        """Wait up to `timeout` seconds for every queued job to finish"""
+        try:
+            await asyncio.wait_for(self.empty.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def submit(self, chat_id, job):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        queue.append(job)
+        self.pending += 1
+        self.empty.clear()
+
+    def depths(self):
+        return {chat_id: len(queue) for chat_id, queue in self.queues.items()}
+
+    def _resume(self, chat_id):
+        del self.deferred[chat_id]
+        self.ready.put_nowait(chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            queue = self.queues[chat_id]
+            try:
+                await self.handler(queue[0])
+            except RetryLater as e:
+                # The job stays first in line and the worker moves on to other chats
+                self.deferred[chat_id] = asyncio.get_running_loop().call_later(e.delay, self._resume, chat_id)
+                continue
+            except Exception as e:
+                metrics.error(e)
+                log.exception("Dispatched job failed", extra={"chat_id": chat_id})
+            queue.popleft()
+            self.pending -= 1
+            if not self.pending:
+                self.empty.set()
+            # Back of the line, behind every other chat that is waiting
+            if queue:
+                self.ready.put_nowait(chat_id)
+            else:
+                del self.queues[chat_id]
+
+class CaptionEditor:
+    """Caption edits under per-chat and global rate limits.
+
+    FloodWaits hold the affected chat for exactly the requested time, transient
+    errors are retried with jittered backoff and edits that still fail are
+    kept in the dead_letters collection.
+    """
+    BACKOFF_BASE = 1
+    BACKOFF_CAP = 30
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(EDIT_GLOBAL_RATE)
+        self.chat_buckets = TTLCache(CONFIG_CACHE_SIZE)
+        self.client = None
+        self.edited = 0
+        self.unchanged = 0
+        self.dead = 0
+
+    @staticmethod
+    def fingerprint(caption, reply_markup):
+        """Stable hash of a caption and its URL buttons"""
+        rows = []
+        if isinstance(reply_markup, InlineKeyboardMarkup):
+            rows = [[(button.text, button.url) for button in row] for row in reply_markup.inline_keyboard]
+        # Telegram trims captions, so a rendered one may not end the way the message does
+        return hashlib.sha1(repr(((caption or "").strip(), rows)).encode()).hexdigest()
+
+    @staticmethod
+    def message_fingerprint(message):
+        """Fingerprint of what a message shows, comparable with a rendered caption"""
+        # message.caption is plain text; .markdown writes its formatting back
+        # the way caption templates spell it
+        caption = message.caption
+        return CaptionEditor.fingerprint(getattr(caption, "markdown", caption), message.reply_markup)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is MISSING:
+            bucket = TokenBucket(EDIT_CHAT_RATE, EDIT_CHAT_BURST)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def edit(self, chat_id, message_id, caption, reply_markup=None, current=None):
+        """Apply a caption: "edited", "unchanged" or "failed". `current` is the
+        fingerprint of what the message already shows.
+
+        Raises RetryLater while the chat is rate limited or in a FloodWait,
+        rather than sleeping through it.
+        """
+        if current is not None and current == self.fingerprint(caption, reply_markup):
+            self.unchanged += 1
+            return "unchanged"
+
+        chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            delay = chat_bucket.try_acquire()
+            if delay:
+                raise RetryLater(delay)
+            with metrics.timer("rate_limit"):
+                await self.global_bucket.acquire()
+            try:
+                with metrics.timer("edit"):
+                    await self.client.edit_message_caption(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        caption=caption,
+                        reply_markup=reply_markup
+                    )
+                self.edited += 1
+                return "edited"
+            except MessageNotModified:
+                self.unchanged += 1
+                return "unchanged"
+            except FloodWait as e:
+                metrics.error(e)
+                # Raised as RetryLater on the next pass
+                chat_bucket.pause(e.value)
+            except TRANSIENT_ERRORS as e:
+                metrics.error(e)
+                attempt += 1
+                if attempt >= EDIT_RETRIES:
+                    await self._dead_letter(chat_id, message_id, caption, e, attempt)
+                    return "failed"
+                # Full jitter keeps retries from many chats from lining up
+                await asyncio.sleep(random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt)))
+            except RPCError as e:
+                metrics.error(e)
+                await self._dead_letter(chat_id, message_id, caption, e, attempt + 1)
+                return "failed"
+
+    async def _dead_letter(self, chat_id, message_id, caption, error, attempts):
+        self.dead += 1
+        log.warning(
+            "Caption edit failed: %r", error,
+            extra={"chat_id": chat_id, "message_id": message_id, "stage": "edit"}
+        )
+        try:
+            await dead_letters_collection.insert_one({
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "caption": caption,
+                "error": type(error).__name__,
+                "detail": str(error),
+                "attempts": attempts,
+                "failed_at": time.time()
+            })
+        except Exception:
+            log.exception("Dead letter store failed", extra={"chat_id": chat_id, "message_id": message_id})
+
+class UserTracker:
+    """Buffers users seen by /start and upserts new or changed ones in one unordered bulk_write"""
+    def __init__(self, batch=USER_FLUSH_BATCH, interval=USER_FLUSH_INTERVAL):
+        self.batch = batch
+        self.interval = interval
+        # Users whose stored fields are known to match, so repeat /starts cost nothing
+        self.known = TTLCache(KNOWN_USERS_CACHE_SIZE)
+        self.pending = {}
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.written = 0
+
+    def track(self, user_id, fields):
+        values = tuple(fields.values())
+        if self.known.get(user_id) == values:
+            return
+        self.known.set(user_id, values)
+        self.pending[user_id] = fields
+        if len(self.pending) >= self.batch:
+            self.full.set()
+
+    async def flush(self):
+        async with self.lock:
+            self.full.clear()
+            if not self.pending:
+                return
+            pending, self.pending = list(self.pending.items()), {}
+            # One bounded bulk_write per batch, even for a backlog left by failed flushes
+            for start in range(0, len(pending), self.batch):
+                batch = pending[start:start + self.batch]
+                try:
+                    result = await users_collection.bulk_write(
+                        [UpdateOne({"user_id": user_id}, {"$set": fields}, upsert=True)
+                         for user_id, fields in batch],
+                        ordered=False
+                    )
+                    self.written += len(batch)
+                    bot_stats.add("users", result.upserted_count)
+                except asyncio.CancelledError:
+                    self.pending = {**dict(pending[start:]), **self.pending}
+                    raise
+                except Exception:
+                    log.exception("User flush failed, retrying with the next batch", extra={"stage": "users"})
+                    # Newer fields that arrived meanwhile win
+                    self.pending = {**dict(pending[start:]), **self.pending}
+                    return
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the timer and write whatever is still buffered"""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+
+caption_editor = CaptionEditor()
+recent_posts = RecentMessages(RECENT_POSTS_PER_CHAT, CONFIG_CACHE_SIZE)
+user_tracker = UserTracker()
 
 def get_user_info(message):
     """Safely get user information from message"""
@@ -285,15 +1530,11 @@ async def start_command(client, message):
     user_id, username = get_user_info(message)
     
     if user_id:
-        # Track user in database
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "username": username,
-                "user_mention": f"@{username}" if message.from_user else username
-            }},
-            upsert=True
-        )
+        # Track user in database; written in batches in the background
+        user_tracker.track(user_id, {
+            "username": username,
+            "user_mention": f"@{username}" if message.from_user else username
+        })
     
     buttons = InlineKeyboardMarkup([
         [InlineKeyboardButton("𝖠𝖻𝗈𝗎𝗍", callback_data='help'),
@@ -331,6 +1572,8 @@ async def help_command(client, message):
         "• `{language}` - Language\n"
         "• `{quality}` - Video quality\n"
         "• `{filesize}` - File size\n"
+        "• `{season|1}` - Season number, or 1 when none is found\n"
+        "• `{#season}...{/season}` - Only shown when a season is found\n"
         "\n**Text Editing Features:**\n"
         "• Remove specific words/lines from captions\n"
         "• Replace words/phrases in captions\n"
@@ -494,6 +1737,9 @@ async def set_caption_command(client, message):
             "• `{language}` - Detected language\n"
             "• `{quality}` - Video quality\n"
             "• `{filesize}` - Formatted file size\n\n"
+            "**Defaults and Conditions:**\n"
+            "• `{episode|Special}` - Use 'Special' when no episode is found\n"
+            "• `{#season}📂 Season: {season}\\n{/season}` - Skip the line when no season is found\n\n"
             "**Example:**\n"
             "`/setcaption 🎬 {filename}\\n📺 Episode: {episode}\\n🎥 {quality} | {language} | {filesize}`"
         )
@@ -547,21 +1793,30 @@ async def my_captions_command(client, message):
         await message.reply("❌ Could not identify user. Please try again.")
         return
     
-    user_captions = channels_collection.find({"user_id": user_id})
-    
-    captions_list = "**📝 Your Auto-Captions:**\n\n"
-    count = 0
-    
-    for caption in user_captions:
-        count += 1
-        chat_title = caption.get("chat_title", "Unknown Chat")
-        caption_preview = caption["caption"][:50] + "..." if len(caption["caption"]) > 50 else caption["caption"]
-        captions_list += f"**{count}. {chat_title}**\n`{caption_preview}`\n\n"
-    
-    if count == 0:
-        captions_list = "❌ You haven't set any auto-captions yet!\nUse `/setcaption` to create one."
+    captions_list, buttons = await my_captions_page(user_id)
+    if captions_list is None:
+        await message.reply("❌ You haven't set any auto-captions yet!\nUse `/setcaption` to create one.")
+        return
     
-    await message.reply(captions_list)
+    await message.reply(captions_list, reply_markup=buttons)
+
+async def my_captions_page(user_id, page=0, anchor=None, backwards=False):
+    """Text and prev/next buttons for one /mycaptions page; the buttons carry the owner and the _id to continue from"""
+    docs, more = await CaptionManager.list_captions(user_id, anchor, backwards)
+    if not docs:
+        return None, None
+
+    lines = ["**📝 Your Auto-Captions:**\n"]
+    for number, doc in enumerate(docs, page * MYCAPTIONS_PAGE_SIZE + 1):
+        preview = doc.get("preview", "") + ("..." if doc.get("truncated") else "")
+        lines.append(f"**{number}. {doc.get('chat_title') or 'Unknown Chat'}**\n`{preview}`\n")
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"mc:p:{user_id}:{docs[0]['_id']}:{page - 1}"))
+    if more or backwards:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"mc:n:{user_id}:{docs[-1]['_id']}:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([navigation]) if navigation else None
 
 # Text editing commands
 @app.on_message(filters.command("removetext"))
@@ -663,356 +1918,725 @@ async def broadcast_command(client, message):
         return
 
     broadcast_text = message.text.split(" ", 1)[1]
-    users = users_collection.find({}, {"user_id": 1})
-    
-    count = 0
-    for user in users:
-        try:
-            await client.send_message(user["user_id"], broadcast_text)
-            count += 1
-            await asyncio.sleep(0.1)  # Prevent flooding
-        except:
-            continue
-    
-    await message.reply(f"✅ Broadcast sent to {count} users.")
+    progress_message = await message.reply("📣 **Broadcast started...**")
+
+    broadcaster = Broadcaster(client, broadcast_text)
+    await broadcaster.run(progress_message)
+
+    elapsed = format_duration(time.monotonic() - broadcaster.started)
+    await progress_message.edit_text(
+        f"✅ Broadcast sent to {broadcaster.sent} users in {elapsed}.\n\n" + broadcaster.summary()
+    )
+
+@app.on_message(filters.command("profile") & filters.user(OWNER_ID))
+async def profile_command(client, message):
+    if Profiler.running:
+        await message.reply("❌ A profile is already running.")
+        return
+
+    try:
+        seconds = int(message.command[1]) if len(message.command) > 1 else PROFILE_SECONDS
+    except ValueError:
+        await message.reply("**Usage:** `/profile [seconds]`")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    profiler = Profiler(seconds)
+    profiler.start()
+    try:
+        progress_message = await message.reply(f"🔬 **Profiling for {seconds}s...**")
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+
+    report = io.BytesIO(profiler.report().encode())
+    report.name = f"profile-{int(time.time())}.txt"
+    await message.reply_document(report, caption=profiler.summary())
+    await progress_message.delete()
 
 @app.on_message(filters.command("users") & filters.user(OWNER_ID))
 async def users_command(client, message):
-    user_count = users_collection.count_documents({})
-    await message.reply(f"📊 **Total Users:** {user_count}")
+    await message.reply(f"📊 **Total Users:** {bot_stats.counts['users']}")
 
 @app.on_message(filters.command("stats"))
 async def stats_command(client, message):
-    total_users = users_collection.count_documents({})
-    total_captions = channels_collection.count_documents({})
-    total_text_settings = text_settings_collection.count_documents({})
-    total_buttons = button_collection.count_documents({})
+    # Served from memory: nothing here touches Mongo
+    counts = bot_stats.counts
+    uptime = time.monotonic() - bot_stats.started
+    per_minute = caption_editor.edited / uptime * 60 if uptime else 0
     
     stats_text = (
         "📊 **Bot Statistics**\n\n"
-        f"👥 **Total Users:** {total_users}\n"
-        f"📝 **Active Captions:** {total_captions}\n"
-        f"🔤 **Text Settings:** {total_text_settings}\n"
-        f"🔘 **Custom Buttons:** {total_buttons}\n"
-        f"⚡ **Bot Status:** Online\n"
+        f"👥 **Total Users:** {counts['users']}\n"
+        f"📝 **Active Captions:** {counts['caption']}\n"
+        f"🔤 **Text Settings:** {counts['text_settings']}\n"
+        f"🔘 **Custom Buttons:** {counts['button']}\n"
+        f"✏️ **Captions Applied:** {caption_editor.edited} ({per_minute:.1f}/min), "
+        f"{caption_editor.dead} failed\n"
+        f"🗂️ **Config Cache:** {config_cache.hits} hits / {config_cache.misses} misses "
+        f"({config_cache.hit_rate:.1f}%)\n"
+        f"📂 **File Info Cache:** {file_info_cache.hits} hits / {file_info_cache.misses} misses "
+        f"({file_info_cache.hit_rate:.1f}%)\n"
+        f"📥 **Caption Queue:** {caption_dispatcher.pending} posts in {len(caption_dispatcher.queues)} chats\n"
+        f"♻️ **Skipped:** {recent_posts.duplicates} duplicate posts, "
+        f"{caption_editor.unchanged} unchanged captions\n"
+        f"⚡ **Bot Status:** Online for {format_duration(uptime)}\n"
         f"🤖 **Version:** v0.1"
     )
+
+    if message.from_user and message.from_user.id == OWNER_ID:
+        stats_text += "\n\n⏱️ **Pipeline (p50 / p99 ms):**\n"
+        for stage, histogram in metrics.stages.items():
+            if histogram.count:
+                stats_text += (
+                    f"• {stage}: {histogram.quantile(0.5) * 1000:.1f} / "
+                    f"{histogram.quantile(0.99) * 1000:.1f} (n={histogram.count})\n"
+                )
+        if metrics.errors:
+            stats_text += "\n⚠️ **Errors:** " + ", ".join(
+                f"{name} {count}" for name, count in sorted(metrics.errors.items(), key=lambda item: -item[1])
+            )
+
     await message.reply(stats_text)
 
+class CaptionJobStore:
+    """Caption jobs persisted before processing, so restarts don't lose posts"""
+    @staticmethod
+    def job_id(chat_id, message_id):
+        return f"{chat_id}:{message_id}"
+
+    @staticmethod
+    async def save(job):
+        """Persist a new job; False if this post was already queued"""
+        document = {key: value for key, value in job.items() if key != "stored"}
+        with metrics.timer("job_store"):
+            result = await caption_jobs_collection.update_one(
+                {"_id": CaptionJobStore.job_id(job["chat_id"], job["message_id"])},
+                {"$setOnInsert": {**document, "created_at": time.time()}},
+                upsert=True
+            )
+        return result.upserted_id is not None
+
+    @staticmethod
+    async def complete(job):
+        with metrics.timer("job_store"):
+            await caption_jobs_collection.delete_one(
+                {"_id": CaptionJobStore.job_id(job["chat_id"], job["message_id"])}
+            )
+
+    @staticmethod
+    async def replay(dispatcher):
+        """Queue jobs left unfinished by the previous run, oldest first"""
+        count = 0
+        async for job in caption_jobs_collection.find({}).sort("created_at", 1):
+            # Redeliveries of these posts are dropped by the handler
+            recent_posts.add(job["chat_id"], job["message_id"])
+            dispatcher.submit(job["chat_id"], job)
+            count += 1
+        return count
+
+async def process_caption_job(job):
+    """Render and apply the caption for one queued channel post"""
+    chat_id = job["chat_id"]
+    # Observed once, not again when a throttled job is retried
+    received_at = job.pop("received_at", None)
+    if received_at is not None:
+        metrics.observe("queue", max(0.0, time.time() - received_at))
+
+    # Cached by the handler's lookup moments ago; replayed jobs may load it
+    config = await ChannelConfigManager.get_config(chat_id)
+    if not config or not config.get("caption"):
+        return
+
+    # Only the fields the caption template uses get parsed, while rendering
+    file_info = FileInfoExtractor.extract_info(job["file_name"], job["file_size"])
+    parsed_before = file_info.parse_seconds
+    started = time.perf_counter()
+
+    # Format caption
+    formatted_caption = CaptionManager.get_template(config).render(file_info)
+
+    parse_seconds = file_info.parse_seconds - parsed_before
+    metrics.observe("parse", parse_seconds)
+    metrics.observe("render", max(0.0, time.perf_counter() - started - parse_seconds))
+
+    # Apply text settings (remove/replace)
+    if config.get("text_settings"):
+        with metrics.timer("text_settings"):
+            formatted_caption = TextSettingsManager.get_rules(config).apply(formatted_caption)
+
+    # Get custom buttons
+    with metrics.timer("buttons"):
+        reply_markup = ButtonManager.get_markup(config)
+
+    return await caption_editor.edit(
+        chat_id, job["message_id"], formatted_caption, reply_markup, job.get("current")
+    )
+
+async def run_caption_job(job):
+    started = time.perf_counter()
+    stored = job.pop("stored", None)
+    if stored is not None:
+        try:
+            # A redelivered post whose stored job is already queued, e.g. by the replay
+            if not await stored:
+                return
+        except Exception as e:
+            # Captioned all the same, it just won't survive a restart
+            metrics.error(e)
+            log.warning("Caption job store failed: %r", e, extra={
+                "chat_id": job["chat_id"], "message_id": job["message_id"], "stage": "job_store"
+            })
+    try:
+        await process_caption_job(job)
+    except RetryLater:
+        raise
+    except Exception as e:
+        metrics.error(e)
+        log.exception("Caption job failed", extra={
+            "chat_id": job["chat_id"], "message_id": job["message_id"], "stage": "caption",
+            "duration": round(time.perf_counter() - started, 4)
+        })
+    else:
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Caption job done", extra={
+                "chat_id": job["chat_id"], "message_id": job["message_id"], "stage": "caption",
+                "duration": round(time.perf_counter() - started, 4)
+            })
+    # Not reached when cancelled at shutdown, so the job is replayed on the next start
+    try:
+        await CaptionJobStore.complete(job)
+    except Exception as e:
+        metrics.error(e)
+        log.warning("Caption job cleanup failed: %r", e, extra={
+            "chat_id": job["chat_id"], "message_id": job["message_id"], "stage": "job_store"
+        })
+
+caption_dispatcher = ChatDispatcher(run_caption_job, DISPATCH_WORKERS)
+
 # Auto-caption handler with text settings and custom buttons
 @app.on_message(filters.channel & (filters.document | filters.video | filters.audio))
 async def auto_caption_handler(client, message):
     try:
-        caption_data = await CaptionManager.get_caption(message.chat.id)
-        if not caption_data:
+        # One round trip for caption, text settings and buttons when not cached
+        with metrics.timer("config"):
+            config = await ChannelConfigManager.get_config(message.chat.id)
+        if not config or not config.get("caption"):
+            return
+
+        # Update redelivered while this post is queued or done
+        if not recent_posts.add(message.chat.id, message.id):
             return
         
-        # Extract file information
-        file_name = (
-            message.document.file_name if message.document else
-            message.video.file_name if message.video else
-            message.audio.file_name if message.audio else
-            "Unknown"
-        )
-        
-        file_size = (
-            message.document.file_size if message.document else
-            message.video.file_size if message.video else
-            message.audio.file_size if message.audio else
-            0
-        )
-        
-        # Extract all file info
-        file_info = FileInfoExtractor.extract_all_info(file_name, file_size)
-        
-        # Format caption
-        formatted_caption = CaptionManager.format_caption(caption_data["caption"], file_info)
-        
-        # Apply text settings (remove/replace)
-        text_settings = await TextSettingsManager.get_text_settings(message.chat.id)
-        if text_settings:
-            formatted_caption = TextSettingsManager.apply_text_settings(formatted_caption, text_settings)
-        
-        # Get custom buttons
-        button_data = await ButtonManager.get_custom_button(message.chat.id)
-        reply_markup = None
-        if button_data:
-            reply_markup = ButtonManager.parse_buttons(button_data.get("button_text", ""))
+        # Extract file information; videos often come without a filename
+        media = message.document or message.video or message.audio
         
-        # Apply caption to the message
-        await client.edit_message_caption(
-            chat_id=message.chat.id,
-            message_id=message.id,
-            caption=formatted_caption,
-            reply_markup=reply_markup
-        )
+        job = {
+            "chat_id": message.chat.id,
+            "message_id": message.id,
+            "file_name": media.file_name or "Unknown",
+            "file_size": media.file_size or 0,
+            "current": CaptionEditor.message_fingerprint(message),
+            "received_at": time.time()
+        }
+        # Stored so the post survives a restart. Queued without waiting for
+        # the write, so posts keep their arrival order; the worker awaits it
+        job["stored"] = asyncio.create_task(CaptionJobStore.save(job))
+
+        # Posts of one channel are captioned in order, channels in parallel
+        caption_dispatcher.submit(message.chat.id, job)
         
     except Exception as e:
-        print(f"Auto-caption error: {e}")
+        metrics.error(e)
+        log.exception("Auto-caption handler failed", extra={
+            "chat_id": message.chat.id, "message_id": message.id, "stage": "receive"
+        })
 
-# Callback query handler
-@app.on_callback_query()
-async def callback_handler(client: app, query: CallbackQuery):
-    data = query.data
-    
-    if data == "help":
-        await query.message.edit_text(
-            text=HELP_TXT.format(first=query.from_user.first_name),
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton('Text Settings', callback_data='text_settings'),
-                 InlineKeyboardButton('Custom Button', callback_data='custom_button')],
-                [InlineKeyboardButton("Close", callback_data='close')]
-            ])
-        )
-    
-    elif data == "start":
-        await query.message.edit_text(
-            text=START_MSG.format(first=query.from_user.first_name),
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Help", callback_data='help'),
-                 InlineKeyboardButton("Text Settings", callback_data='text_settings')],
-                [InlineKeyboardButton("Custom Button", callback_data='custom_button')],
-                [InlineKeyboardButton("Close", callback_data='close')],
-                [InlineKeyboardButton("OWNER", url='https://t.me/Team_Wine')]
-            ])
+class Backfill:
+    """Re-captions a chat's existing posts, newest first, with a checkpoint after every batch"""
+    PROGRESS_INTERVAL = 5
+    running = {}
+
+    def __init__(self, client, chat_id, top_id, checkpoint=None):
+        checkpoint = checkpoint or {}
+        self.client = client
+        self.chat_id = chat_id
+        self.top_id = checkpoint.get("top_id", top_id)
+        self.next_id = checkpoint.get("next_id", top_id)
+        self.updated = checkpoint.get("updated", 0)
+        self.unchanged = checkpoint.get("unchanged", 0)
+        self.failed = checkpoint.get("failed", 0)
+        self.resumed = bool(checkpoint)
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.first_id = self.next_id
+
+    def summary(self):
+        scanned = self.top_id - self.next_id
+        elapsed = time.monotonic() - self.started
+        speed = (self.first_id - self.next_id) / elapsed if elapsed else 0
+        eta = self.next_id / speed if speed else 0
+        percent = scanned / self.top_id * 100 if self.top_id else 100
+        return (
+            f"✏️ **Updated:** {self.updated}\n"
+            f"⏭️ **Already up to date:** {self.unchanged}\n"
+            f"❌ **Failed:** {self.failed}\n"
+            f"📊 **Progress:** {scanned}/{self.top_id} messages ({percent:.1f}%)\n"
+            f"⏳ **ETA:** {format_duration(eta) if speed else 'estimating...'}"
         )
-    
-    elif data == "text_settings":
-        buttons = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🧹 Remove Text", callback_data='remove_text'),
-             InlineKeyboardButton("♻️ Replace Text", callback_data='replace_text')],
-            [InlineKeyboardButton("📋 View Settings", callback_data='view_text_settings'),
-             InlineKeyboardButton("🗑️ Clear All", callback_data='clear_text_settings')],
-            [InlineKeyboardButton("📖 Guide", callback_data='text_guide'),
-             InlineKeyboardButton("🔙 Back", callback_data='help')]
-        ])
-        
-        await query.message.edit_text(
-            "🔤 **Text Settings Menu**\n\n"
-            "Customize how captions are processed before being applied:\n\n"
-            "• 🧹 **Remove Text**: Delete specific words/lines\n"
-            "• ♻️ **Replace Text**: Change words/phrases\n"
-            "• 📋 **View Settings**: See current configurations\n"
-            "• 🗑️ **Clear All**: Remove all text settings\n"
-            "• 📖 **Guide**: Learn how to use these features",
-            reply_markup=buttons
+
+    async def _get_messages(self, message_ids):
+        for attempt in range(EDIT_RETRIES):
+            try:
+                return await self.client.get_messages(self.chat_id, message_ids)
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except TRANSIENT_ERRORS:
+                await asyncio.sleep(2 ** attempt)
+        return await self.client.get_messages(self.chat_id, message_ids)
+
+    async def _recaption(self, message, semaphore):
+        media = message.document or message.video or message.audio
+        if not media:
+            return None
+        job = {
+            "chat_id": self.chat_id,
+            "message_id": message.id,
+            "file_name": media.file_name or "Unknown",
+            "file_size": media.file_size or 0,
+            # Posts that already carry the current caption cost no API call, which makes resuming cheap
+            "current": CaptionEditor.message_fingerprint(message)
+        }
+        async with semaphore:
+            while not self.cancelled:
+                try:
+                    return await process_caption_job(job)
+                except RetryLater as e:
+                    await asyncio.sleep(e.delay)
+            return None
+
+    async def _checkpoint(self):
+        await backfills_collection.update_one(
+            {"_id": self.chat_id},
+            {"$set": {
+                "top_id": self.top_id,
+                "next_id": self.next_id,
+                "updated": self.updated,
+                "unchanged": self.unchanged,
+                "failed": self.failed,
+                "updated_at": time.time()
+            }},
+            upsert=True
         )
-    
-    elif data == "custom_button":
-        buttons = InlineKeyboardMarkup([
-            [InlineKeyboardButton("➕ Set Button", callback_data='set_button'),
-             InlineKeyboardButton("👀 View Button", callback_data='view_button')],
-            [InlineKeyboardButton("🗑️ Remove Button", callback_data='remove_button'),
-             InlineKeyboardButton("📖 Button Guide", callback_data='button_guide')],
-            [InlineKeyboardButton("🔙 Back", callback_data='help')]
-        ])
-        
-        await query.message.edit_text(
-            "🔘 **Custom Button Menu**\n\n"
-            "Add custom inline buttons to your messages:\n\n"
-            "• ➕ **Set Button**: Add custom buttons to messages\n"
-            "• 👀 **View Button**: See current button configuration\n"
-            "• 🗑️ **Remove Button**: Remove custom buttons\n"
-            "• 📖 **Button Guide**: Learn button format\n\n"
-            "**Format:**\n"
-            "`[Button Text][buttonurl:https://example.com]`",
-            reply_markup=buttons
+
+    async def _report(self, progress_message):
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            try:
+                await progress_message.edit_text("🔄 **Recaptioning...**\n\n" + self.summary())
+            except RPCError as e:
+                log.debug("Recaption progress update failed: %r", e, extra={"chat_id": self.chat_id})
+
+    async def run(self, progress_message):
+        """Walk down from next_id; False if cancelled, leaving the checkpoint to resume from"""
+        semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+        reporter = asyncio.create_task(self._report(progress_message))
+        try:
+            while self.next_id > 0:
+                message_ids = list(range(self.next_id, max(0, self.next_id - BACKFILL_BATCH), -1))
+                messages = await self._get_messages(message_ids)
+                results = await asyncio.gather(*(
+                    self._recaption(message, semaphore) for message in messages if not message.empty
+                ))
+                if self.cancelled:
+                    # Part of this batch was skipped; the resumed run redoes it
+                    return False
+                self.updated += results.count("edited")
+                self.unchanged += results.count("unchanged")
+                self.failed += results.count("failed")
+                self.next_id = message_ids[-1] - 1
+                await self._checkpoint()
+        finally:
+            reporter.cancel()
+        await backfills_collection.delete_one({"_id": self.chat_id})
+        return True
+
+# Channels only: in groups a bot can edit nothing but its own messages. A
+# channel post carries no sender, so any admin who can post may run it
+@app.on_message(filters.command("recaption") & filters.channel)
+async def recaption_command(client, message):
+    chat_id = message.chat.id
+
+    config = await ChannelConfigManager.get_config(chat_id)
+    if not config or not config.get("caption"):
+        await message.reply("❌ No caption set for this chat. Use /setcaption first.")
+        return
+
+    if len(message.command) > 1 and message.command[1].lower() == "cancel":
+        running = Backfill.running.get(chat_id)
+        if not running:
+            await message.reply("❌ No recaption is running in this chat.")
+            return
+        running.cancelled = True
+        await message.reply("⏹️ Cancelling... Send /recaption later to resume.")
+        return
+
+    checkpoint = await backfills_collection.find_one({"_id": chat_id})
+    if chat_id in Backfill.running:
+        await message.reply("❌ A recaption is already running in this chat. Use `/recaption cancel` to stop it.")
+        return
+    # Everything posted before this command
+    backfill = Backfill(client, chat_id, message.id - 1, checkpoint)
+    Backfill.running[chat_id] = backfill
+    try:
+        progress_message = await message.reply(
+            "🔄 **Resuming recaption...**" if backfill.resumed else "🔄 **Recaption started...**"
         )
+        finished = await backfill.run(progress_message)
+    finally:
+        Backfill.running.pop(chat_id, None)
+
+    status = "✅ **Recaption finished.**" if finished else "⏸️ **Recaption cancelled.** Send /recaption to resume."
+    await progress_message.edit_text(f"{status}\n\n" + backfill.summary())
+
+class CallbackRouter:
+    """Dispatches callback queries by exact data or by the "prefix:" of parameterized data"""
+    def __init__(self):
+        self.routes = {}
+        self.prefixes = {}
+
+    def route(self, data):
+        def register(handler):
+            self.routes[data] = handler
+            return handler
+        return register
+
+    def prefix(self, prefix):
+        def register(handler):
+            self.prefixes[prefix] = handler
+            return handler
+        return register
+
+    def menu(self, data, text, rows, personal=False):
+        """Static menu, built once; `personal` texts are formatted with the user's first name"""
+        markup = InlineKeyboardMarkup(rows)
+
+        async def show(client, query):
+            await query.message.edit_text(
+                text.format(first=query.from_user.first_name) if personal else text,
+                disable_web_page_preview=True,
+                reply_markup=markup
+            )
+        self.routes[data] = show
+
+    async def dispatch(self, client, query):
+        data = query.data or ""
+        handler = self.routes.get(data) or self.prefixes.get(data.split(":", 1)[0])
+        if handler:
+            await handler(client, query)
+
+callback_router = CallbackRouter()
+
+def back_button(data):
+    return [InlineKeyboardButton("🔙 Back", callback_data=data)]
+
+callback_router.menu("help", HELP_TXT, [
+    [InlineKeyboardButton('Text Settings', callback_data='text_settings'),
+     InlineKeyboardButton('Custom Button', callback_data='custom_button')],
+    [InlineKeyboardButton("Close", callback_data='close')]
+], personal=True)
+
+callback_router.menu("start", START_MSG, [
+    [InlineKeyboardButton("Help", callback_data='help'),
+     InlineKeyboardButton("Text Settings", callback_data='text_settings')],
+    [InlineKeyboardButton("Custom Button", callback_data='custom_button')],
+    [InlineKeyboardButton("Close", callback_data='close')],
+    [InlineKeyboardButton("OWNER", url='https://t.me/Team_Wine')]
+], personal=True)
+
+callback_router.menu("text_settings", (
+    "🔤 **Text Settings Menu**\n\n"
+    "Customize how captions are processed before being applied:\n\n"
+    "• 🧹 **Remove Text**: Delete specific words/lines\n"
+    "• ♻️ **Replace Text**: Change words/phrases\n"
+    "• 📋 **View Settings**: See current configurations\n"
+    "• 🗑️ **Clear All**: Remove all text settings\n"
+    "• 📖 **Guide**: Learn how to use these features"
+), [
+    [InlineKeyboardButton("🧹 Remove Text", callback_data='remove_text'),
+     InlineKeyboardButton("♻️ Replace Text", callback_data='replace_text')],
+    [InlineKeyboardButton("📋 View Settings", callback_data='view_text_settings'),
+     InlineKeyboardButton("🗑️ Clear All", callback_data='clear_text_settings')],
+    [InlineKeyboardButton("📖 Guide", callback_data='text_guide'),
+     InlineKeyboardButton("🔙 Back", callback_data='help')]
+])
+
+callback_router.menu("custom_button", (
+    "🔘 **Custom Button Menu**\n\n"
+    "Add custom inline buttons to your messages:\n\n"
+    "• ➕ **Set Button**: Add custom buttons to messages\n"
+    "• 👀 **View Button**: See current button configuration\n"
+    "• 🗑️ **Remove Button**: Remove custom buttons\n"
+    "• 📖 **Button Guide**: Learn button format\n\n"
+    "**Format:**\n"
+    "`[Button Text][buttonurl:https://example.com]`"
+), [
+    [InlineKeyboardButton("➕ Set Button", callback_data='set_button'),
+     InlineKeyboardButton("👀 View Button", callback_data='view_button')],
+    [InlineKeyboardButton("🗑️ Remove Button", callback_data='remove_button'),
+     InlineKeyboardButton("📖 Button Guide", callback_data='button_guide')],
+    back_button('help')
+])
+
+callback_router.menu("text_guide", (
+    "🔤 **Text Settings Guide**\n\n"
+    "With these options, you can fully customize the message text.\n"
+    "Here's what each button does:\n\n"
+    "• 🧹 **Remove Text**: Delete any word or line from the original caption/text.\n"
+    "   ➤ Example: Remove the word 'Telegram' from the message.\n\n"
+    "• ♻️ **Replace Text**: Change specific words or phrases in the message.\n"
+    "   ➤ Example: Replace 'Telegram' with 'WhatsApp'.\n\n"
+    "**Usage Commands:**\n"
+    "• `/removetext word` - Remove specific text\n"
+    "• `/replacetext old new` - Replace text\n"
+    "• `/showtextsettings` - View current settings\n"
+    "• `/cleartextsettings` - Clear all settings\n\n"
+    "Use these features to clean, edit or enhance captions, descriptions, or messages easily."
+), [back_button('text_settings')])
+
+callback_router.menu("button_guide", (
+    "🔘 **Custom Button Guide**\n\n"
+    "You Can Set A Inline Button To Messages.\n\n"
+    "**Format:**\n"
+    "`[Button Text][buttonurl:https://example.com]`\n\n"
+    "**Examples:**\n"
+    "• Single button:\n"
+    "`[Rkn Developer][buttonurl:https://t.me/RknDeveloper]`\n\n"
+    "• Multiple buttons (one per line):\n"
+    "`[Join Channel][buttonurl:https://t.me/Channel1]\n"
+    "[Download][buttonurl:https://t.me/Channel2]\n"
+    "[Support][buttonurl:https://t.me/Channel3]`\n\n"
+    "**Note:**\n"
+    "• URLs must start with http://, https://, or t.me/\n"
+    "• Each button should be on a new line for multiple buttons\n"
+    "• Buttons will appear in the order you specify"
+), [back_button('custom_button')])
+
+callback_router.menu("set_button", (
+    "➕ **Set Custom Button**\n\n"
+    "**Format:**\n"
+    "`[Button Text][buttonurl:https://example.com]`\n\n"
+    "**Examples:**\n"
+    "• Single button:\n"
+    "`[Join Channel][buttonurl:https://t.me/YourChannel]`\n\n"
+    "• Multiple buttons:\n"
+    "`[Channel][buttonurl:https://t.me/Channel1]\n"
+    "[Group][buttonurl:https://t.me/Group1]\n"
+    "[Download][buttonurl:https://example.com]`\n\n"
+    "**Usage:**\n"
+    "You can use the command:\n"
+    "`/setbutton [Text][buttonurl:URL]`\n\n"
+    "Or send the button format directly after clicking 'Set Button'"
+), [back_button('custom_button')])
+
+callback_router.menu("remove_text", (
+    "🧹 **Remove Text**\n\n"
+    "**Usage:** Send the text you want to remove from captions.\n\n"
+    "**Examples:**\n"
+    "• `Telegram` - Removes the word 'Telegram'\n"
+    "• `http://example.com` - Removes a specific URL\n"
+    "• `Download now` - Removes the phrase 'Download now'\n\n"
+    "You can also use the command:\n"
+    "`/removetext text_to_remove`"
+), [back_button('text_settings')])
+
+callback_router.menu("replace_text", (
+    "♻️ **Replace Text**\n\n"
+    "**Usage:** Send the text replacement in format:\n"
+    "`old_text new_text`\n\n"
+    "**Examples:**\n"
+    "• `Telegram WhatsApp` - Replaces 'Telegram' with 'WhatsApp'\n"
+    "• `HD 1080p` - Replaces 'HD' with '1080p'\n"
+    "• `movie film` - Replaces 'movie' with 'film'\n\n"
+    "You can also use the command:\n"
+    "`/replacetext old_text new_text`"
+), [back_button('text_settings')])
+
+BUTTON_MENU_BACK = InlineKeyboardMarkup([back_button('custom_button')])
+TEXT_SETTINGS_BACK = InlineKeyboardMarkup([back_button('text_settings')])
+
+# Views of the chat's settings read the cached config, like the caption pipeline does
+@callback_router.route("view_button")
+async def view_button_callback(client, query):
+    config = await ChannelConfigManager.get_config(query.message.chat.id)
+    button_data = config.get("button") if config else None
     
-    elif data == "text_guide":
-        guide_text = (
-            "🔤 **Text Settings Guide**\n\n"
-            "With these options, you can fully customize the message text.\n"
-            "Here's what each button does:\n\n"
-            "• 🧹 **Remove Text**: Delete any word or line from the original caption/text.\n"
-            "   ➤ Example: Remove the word 'Telegram' from the message.\n\n"
-            "• ♻️ **Replace Text**: Change specific words or phrases in the message.\n"
-            "   ➤ Example: Replace 'Telegram' with 'WhatsApp'.\n\n"
-            "**Usage Commands:**\n"
-            "• `/removetext word` - Remove specific text\n"
-            "• `/replacetext old new` - Replace text\n"
-            "• `/showtextsettings` - View current settings\n"
-            "• `/cleartextsettings` - Clear all settings\n\n"
-            "Use these features to clean, edit or enhance captions, descriptions, or messages easily."
-        )
-        
-        await query.message.edit_text(
-            guide_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='text_settings')]
-            ])
-        )
+    if not button_data:
+        await query.answer("No custom button set for this chat.", show_alert=True)
+        return
     
-    elif data == "button_guide":
-        guide_text = (
-            "🔘 **Custom Button Guide**\n\n"
-            "You Can Set A Inline Button To Messages.\n\n"
-            "**Format:**\n"
-            "`[Button Text][buttonurl:https://example.com]`\n\n"
-            "**Examples:**\n"
-            "• Single button:\n"
-            "`[Rkn Developer][buttonurl:https://t.me/RknDeveloper]`\n\n"
-            "• Multiple buttons (one per line):\n"
-            "`[Join Channel][buttonurl:https://t.me/Channel1]\n"
-            "[Download][buttonurl:https://t.me/Channel2]\n"
-            "[Support][buttonurl:https://t.me/Channel3]`\n\n"
-            "**Note:**\n"
-            "• URLs must start with http://, https://, or t.me/\n"
-            "• Each button should be on a new line for multiple buttons\n"
-            "• Buttons will appear in the order you specify"
-        )
-        
-        await query.message.edit_text(
-            guide_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='custom_button')]
-            ])
-        )
+    preview_text = (
+        f"🔘 **Current Custom Button:**\n\n"
+        f"`{button_data.get('button_text', '')}`\n\n"
+        f"👤 **Set by:** {button_data.get('username', 'Unknown')}\n\n"
+        f"**Preview:**"
+    )
     
-    elif data == "set_button":
-        await query.message.edit_text(
-            "➕ **Set Custom Button**\n\n"
-            "**Format:**\n"
-            "`[Button Text][buttonurl:https://example.com]`\n\n"
-            "**Examples:**\n"
-            "• Single button:\n"
-            "`[Join Channel][buttonurl:https://t.me/YourChannel]`\n\n"
-            "• Multiple buttons:\n"
-            "`[Channel][buttonurl:https://t.me/Channel1]\n"
-            "[Group][buttonurl:https://t.me/Group1]\n"
-            "[Download][buttonurl:https://example.com]`\n\n"
-            "**Usage:**\n"
-            "You can use the command:\n"
-            "`/setbutton [Text][buttonurl:URL]`\n\n"
-            "Or send the button format directly after clicking 'Set Button'",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='custom_button')]
-            ])
-        )
+    await query.message.edit_text(
+        preview_text,
+        reply_markup=ButtonManager.get_markup(config) or BUTTON_MENU_BACK
+    )
+
+@callback_router.route("remove_button")
+async def remove_button_callback(client, query):
+    success = await ButtonManager.remove_custom_button(query.message.chat.id, query.from_user.id)
     
-    elif data == "view_button":
-        user_id = query.from_user.id
-        button_data = await ButtonManager.get_custom_button(query.message.chat.id)
-        
-        if not button_data:
-            await query.answer("No custom button set for this chat.", show_alert=True)
-            return
-        
-        button_owner = button_data.get("username", "Unknown")
-        button_text = button_data.get("button_text", "")
-        
-        # Create preview with actual buttons
-        parsed_buttons = ButtonManager.parse_buttons(button_text)
-        
-        preview_text = (
-            f"🔘 **Current Custom Button:**\n\n"
-            f"`{button_text}`\n\n"
-            f"👤 **Set by:** {button_owner}\n\n"
-            f"**Preview:**"
-        )
-        
-        await query.message.edit_text(
-            preview_text,
-            reply_markup=parsed_buttons or InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='custom_button')]
-            ])
-        )
+    if success:
+        await query.message.edit_text("✅ Custom button removed successfully!", reply_markup=BUTTON_MENU_BACK)
+    else:
+        await query.answer("No custom button found or you don't have permission to remove it!", show_alert=True)
+
+@callback_router.route("view_text_settings")
+async def view_text_settings_callback(client, query):
+    config = await ChannelConfigManager.get_config(query.message.chat.id)
+    settings = config.get("text_settings") if config else None
     
-    elif data == "remove_button":
-        user_id = query.from_user.id
-        success = await ButtonManager.remove_custom_button(query.message.chat.id, user_id)
-        
-        if success:
-            await query.message.edit_text(
-                "✅ Custom button removed successfully!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data='custom_button')]
-                ])
-            )
-        else:
-            await query.answer("No custom button found or you don't have permission to remove it!", show_alert=True)
+    if not settings:
+        await query.answer("No text settings configured for this chat.", show_alert=True)
+        return
     
-    elif data == "remove_text":
-        await query.message.edit_text(
-            "🧹 **Remove Text**\n\n"
-            "**Usage:** Send the text you want to remove from captions.\n\n"
-            "**Examples:**\n"
-            "• `Telegram` - Removes the word 'Telegram'\n"
-            "• `http://example.com` - Removes a specific URL\n"
-            "• `Download now` - Removes the phrase 'Download now'\n\n"
-            "You can also use the command:\n"
-            "`/removetext text_to_remove`",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='text_settings')]
-            ])
-        )
+    lines = ["🔤 **Current Text Settings:**\n"]
     
-    elif data == "replace_text":
-        await query.message.edit_text(
-            "♻️ **Replace Text**\n\n"
-            "**Usage:** Send the text replacement in format:\n"
-            "`old_text new_text`\n\n"
-            "**Examples:**\n"
-            "• `Telegram WhatsApp` - Replaces 'Telegram' with 'WhatsApp'\n"
-            "• `HD 1080p` - Replaces 'HD' with '1080p'\n"
-            "• `movie film` - Replaces 'movie' with 'film'\n\n"
-            "You can also use the command:\n"
-            "`/replacetext old_text new_text`",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='text_settings')]
-            ])
-        )
+    if settings.get('remove_texts'):
+        lines.append("🧹 **Texts to Remove:**")
+        lines += [f"• `{text}`" for text in settings['remove_texts']]
+        lines.append("")
     
-    elif data == "view_text_settings":
-        user_id = query.from_user.id
-        settings = await TextSettingsManager.get_text_settings(query.message.chat.id)
-        
-        if not settings:
-            await query.answer("No text settings configured for this chat.", show_alert=True)
-            return
-        
-        settings_text = "🔤 **Current Text Settings:**\n\n"
-        
-        if 'remove_texts' in settings and settings['remove_texts']:
-            settings_text += "🧹 **Texts to Remove:**\n"
-            for text in settings['remove_texts']:
-                settings_text += f"• `{text}`\n"
-            settings_text += "\n"
-        
-        if 'replace_texts' in settings and settings['replace_texts']:
-            settings_text += "♻️ **Text Replacements:**\n"
-            for old_text, new_text in settings['replace_texts'].items():
-                settings_text += f"• `{old_text}` → `{new_text}`\n"
-        
-        await query.message.edit_text(
-            settings_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data='text_settings')]
-            ])
-        )
+    if settings.get('replace_texts'):
+        lines.append("♻️ **Text Replacements:**")
+        lines += [f"• `{old_text}` → `{new_text}`" for old_text, new_text in settings['replace_texts'].items()]
     
-    elif data == "clear_text_settings":
-        user_id = query.from_user.id
-        success = await TextSettingsManager.clear_all_settings(query.message.chat.id, user_id)
-        
-        if success:
-            await query.message.edit_text(
-                "✅ All text settings cleared successfully!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data='text_settings')]
-                ])
-            )
-        else:
-            await query.answer("No text settings found or you don't have permission to clear them!", show_alert=True)
+    await query.message.edit_text("\n".join(lines), reply_markup=TEXT_SETTINGS_BACK)
+
+@callback_router.route("clear_text_settings")
+async def clear_text_settings_callback(client, query):
+    success = await TextSettingsManager.clear_all_settings(query.message.chat.id, query.from_user.id)
     
-    elif data == "close":
-        await query.message.delete()
+    if success:
+        await query.message.edit_text("✅ All text settings cleared successfully!", reply_markup=TEXT_SETTINGS_BACK)
+    else:
+        await query.answer("No text settings found or you don't have permission to clear them!", show_alert=True)
+
+@callback_router.prefix("mc")
+async def my_captions_callback(client, query):
+    # /mycaptions pages: mc:<n|p>:<owner id>:<anchor _id>:<page>. The owner is
+    # a channel's id when the list was asked for by the channel itself
+    _, direction, owner_id, anchor, page = query.data.split(":")
+    owner_id = int(owner_id)
+    if owner_id > 0 and owner_id != query.from_user.id:
+        await query.answer("These captions belong to someone else.", show_alert=True)
+        return
+    captions_list, buttons = await my_captions_page(
+        owner_id, int(page), ObjectId(anchor), direction == "p"
+    )
+    if captions_list is None:
+        await query.answer("No more captions.", show_alert=True)
+        return
+    await query.message.edit_text(captions_list, reply_markup=buttons)
+
+@callback_router.route("close")
+async def close_callback(client, query):
+    await query.message.delete()
+    if query.message.reply_to_message:
         try:
             await query.message.reply_to_message.delete()
-        except:
-            pass
+        except RPCError as e:
+            log.debug("Could not delete the command message: %r", e, extra={"chat_id": query.message.chat.id})
+
+# Callback query handler
+@app.on_callback_query()
+async def callback_handler(client: app, query: CallbackQuery):
+    await callback_router.dispatch(client, query)
+
+def render_prometheus():
+    """Metrics in the Prometheus text exposition format"""
+    lines = [
+        "# HELP juzi_stage_seconds Auto-caption pipeline stage latency.",
+        "# TYPE juzi_stage_seconds histogram"
+    ]
+    for stage, histogram in metrics.stages.items():
+        cumulative = 0
+        for bound, count in zip(histogram.BOUNDS + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append(f'juzi_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'juzi_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'juzi_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+    lines += ["# HELP juzi_errors_total Errors by exception type.", "# TYPE juzi_errors_total counter"]
+    lines += [f'juzi_errors_total{{type="{name}"}} {count}' for name, count in metrics.errors.items()]
+
+    depths = caption_dispatcher.depths()
+    counters = (
+        ("juzi_captions_edited_total", "Captions applied.", caption_editor.edited),
+        ("juzi_captions_unchanged_total", "Edits skipped because nothing changed.", caption_editor.unchanged),
+        ("juzi_captions_dead_total", "Edits moved to dead_letters.", caption_editor.dead),
+        ("juzi_posts_duplicate_total", "Redelivered posts skipped.", recent_posts.duplicates),
+        ("juzi_config_cache_hits_total", "Config cache hits.", config_cache.hits),
+        ("juzi_config_cache_misses_total", "Config cache misses.", config_cache.misses),
+        ("juzi_file_info_cache_hits_total", "File info cache hits.", file_info_cache.hits),
+        ("juzi_file_info_cache_misses_total", "File info cache misses.", file_info_cache.misses)
+    )
+    gauges = (
+        ("juzi_queue_pending", "Caption jobs queued or in progress.", caption_dispatcher.pending),
+        ("juzi_queue_chats", "Chats with queued caption jobs.", len(depths)),
+        ("juzi_queue_max_depth", "Deepest per-chat caption queue.", max(depths.values(), default=0))
+    )
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        for name, help_text, value in series:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+    return "\n".join(lines) + "\n"
+
+async def metrics_endpoint(request):
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT; a port of 0 turns it off"""
+    if not METRICS_PORT:
+        return None
+    server = web.Application()
+    server.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
+
+async def main():
+    log_listener = setup_logging()
+    await ChannelConfigManager.migrate_legacy_collections()
+    await SchemaManager.bootstrap()
+    # Queued before any update can arrive, so new posts line up behind them
+    replayed = await CaptionJobStore.replay(caption_dispatcher)
+    if replayed:
+        log.info("Replaying %d unfinished caption jobs", replayed)
+    await app.start()
+    caption_editor.client = app
+    caption_dispatcher.start()
+    user_tracker.start()
+    bot_stats.start()
+    metrics_runner = await start_metrics_server()
+    log.info("𝖩𝗎𝗓𝗂 𝖲𝗍𝖺𝗋𝗍𝖾𝖽 !")
+    await idle()
+    # Let in-flight captions finish; whatever is left is replayed on the next start
+    if not await caption_dispatcher.drain(SHUTDOWN_DRAIN_TIMEOUT):
+        log.warning("Shutting down with %d caption jobs pending", caption_dispatcher.pending)
+    await caption_dispatcher.stop()
+    await user_tracker.stop()
+    bot_stats.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await app.stop()
+    log_listener.stop()
 
-print("𝖩𝗎𝗓𝗂 𝖲𝗍𝖺𝗋𝗍𝖾𝖽 !")
-app.run()
+if __name__ == "__main__":
+    app.run(main())
@@ -0,0 +1,96 @@
+"""Micro-benchmark for the filename quality/language classifiers.
+
+Compares the word-index classifiers used by FileInfoExtractor against the
+previous implementation, which ran one r'\\b(...)\\b' regex search per tag in
+priority order, on the release filenames in release_filenames.txt.
+
+Run from the repository root with the bot's requirements installed:
+
+    python benchmarks/classifier.py [--number 2000]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Juzi import FileInfoExtractor, LANGUAGE_WORDS, QUALITY_WORDS, filename_tokens
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "release_filenames.txt")
+
+# The pattern lists FileInfoExtractor used before the word index
+QUALITY_PATTERNS = [
+    (re.compile(r'\b(' + '|'.join(words) + r')\b', re.IGNORECASE), label)
+    for words, label in QUALITY_WORDS
+]
+LANGUAGE_PATTERNS = [
+    (re.compile(r'\b(' + '|'.join(words) + r')\b', re.IGNORECASE), label)
+    for words, label in LANGUAGE_WORDS
+]
+
+
+def sequential_quality(filename):
+    for pattern, quality in QUALITY_PATTERNS:
+        if pattern.search(filename):
+            return quality
+    return "HD"
+
+
+def sequential_language(filename):
+    for pattern, language in LANGUAGE_PATTERNS:
+        if pattern.search(filename):
+            return language
+    return "Multi"
+
+
+def sequential_both(filename):
+    return sequential_quality(filename), sequential_language(filename)
+
+
+def indexed_both(filename):
+    return FileInfoExtractor.extract_quality(filename), FileInfoExtractor.extract_language(filename)
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as corpus:
+        return [line.strip() for line in corpus if line.strip()]
+
+
+def run(label, classify, filenames, number):
+    def one_pass():
+        # Every post tokenizes its filename once; don't let passes share the cache
+        filename_tokens.cache_clear()
+        for name in filenames:
+            classify(name)
+
+    total = timeit.timeit(one_pass, number=number)
+    per_call = total / (number * len(filenames)) * 1e6
+    print(f"{label:<34} {per_call:8.3f} us/filename")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="passes over the corpus")
+    parser.add_argument("--corpus", default=CORPUS, help="file with one filename per line")
+    args = parser.parse_args()
+
+    filenames = load_corpus(args.corpus)
+    for name in filenames:
+        assert sequential_both(name) == indexed_both(name), name
+    print(f"{len(filenames)} filenames, {args.number} passes, results identical\n")
+
+    for field, old, new in (
+        ("quality", sequential_quality, FileInfoExtractor.extract_quality),
+        ("language", sequential_language, FileInfoExtractor.extract_language),
+        ("quality + language", sequential_both, indexed_both),
+    ):
+        before = run(f"{field} (regex list)", old, filenames, args.number)
+        after = run(f"{field} (word index)", new, filenames, args.number)
+        print(f"{'speedup':<34} {before / after:8.2f}x\n")
+
+
+if __name__ == "__main__":
+    main()
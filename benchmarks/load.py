@@ -0,0 +1,235 @@
+"""Load generator and saturation test for the auto-caption dispatcher.
+
+Replays bursts of channel media posts shaped like real traffic through
+auto_caption_handler at increasing offered rates: single posts spread over
+many channels, albums of 10, and large dumps into one channel. Edits go to a
+simulated Telegram backend that enforces its own global and per-chat limits,
+answers with FloodWait when they are exceeded and adds API latency. MongoDB is
+mongomock, as in replay.py.
+
+Each step reports achieved throughput and end-to-end latency (post received to
+caption edited) of the regular traffic, and how long the dumps took to drain,
+which the per-chat limit bounds however many workers run. The saturation
+point is the highest offered rate that kept up: nothing left unfinished,
+p99 latency under --slo, and steady-state throughput (the last three quarters
+of the step, after warm-up) within 20% of the arrival rate over that window.
+
+The run is time-compressed by --speedup: every rate, on both the bot and the
+backend side, is multiplied by it and the results are scaled back, so rates
+and latencies are reported in real Telegram time. The bot's own CPU time is
+compressed too, so lower the speedup if the top steps can't keep pace.
+
+    python benchmarks/load.py [--rates 5,10,20,40,80] [--workers 16] [--channels 200]
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from replay import CORPUS, FakeClient, FakeMessage, install_fake_mongo, seed
+
+import Juzi
+from Juzi import ChatDispatcher, FloodWait, Metrics, TokenBucket, run_caption_job
+from config import DISPATCH_WORKERS, EDIT_GLOBAL_RATE, EDIT_CHAT_RATE
+
+ALBUM_SIZE = 10
+
+
+class Limit:
+    """Non-blocking token bucket: take() returns 0, or how long until a token is free"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SimulatedTelegram(FakeClient):
+    """Edits are rate limited like Telegram's and rejected with FloodWait past the limit"""
+    def __init__(self, latency, global_rate, global_burst, chat_rate, chat_burst):
+        super().__init__(latency)
+        self.global_limit = Limit(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_limits = {}
+        self.completed = {}
+
+    async def edit_message_caption(self, chat_id, message_id, caption, reply_markup=None):
+        chat_limit = self.chat_limits.get(chat_id)
+        if chat_limit is None:
+            chat_limit = self.chat_limits[chat_id] = Limit(self.chat_rate, self.chat_burst)
+        wait = max(chat_limit.take(), self.global_limit.take())
+        if wait:
+            self.calls["flood_wait"] += 1
+            error = FloodWait(value=math.ceil(wait))
+            # Time-compressed runs need sub-second waits
+            error.value = wait
+            raise error
+        await super().edit_message_caption(chat_id, message_id, caption, reply_markup)
+        self.completed[chat_id, message_id] = time.monotonic()
+
+
+def traffic(rate, duration, channels, dump_channels, album_share, dumps, dump_size, rng):
+    """(second, chat_id, is_dump) arrivals: single posts and albums at `rate` posts/s plus `dumps` dumps"""
+    mean_burst = album_share * ALBUM_SIZE + (1 - album_share)
+    arrivals = []
+    now = rng.expovariate(rate / mean_burst)
+    while now < duration:
+        chat_id = rng.choice(channels)
+        size = ALBUM_SIZE if rng.random() < album_share else 1
+        arrivals += [(now + n * 0.05, chat_id, False) for n in range(size)]
+        now += rng.expovariate(rate / mean_burst)
+    for _ in range(dumps):
+        chat_id, start = rng.choice(dump_channels), rng.uniform(0, duration)
+        # A bulk upload: a few files a second for as long as it takes
+        arrivals += [(start + n * 0.2, chat_id, True) for n in range(dump_size)]
+    return sorted(arrivals)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def step(args, rate, channels, dump_channels, filenames, rng):
+    client = SimulatedTelegram(
+        args.latency / 1000 / args.speedup,
+        args.global_rate * args.speedup,
+        args.global_rate,
+        args.chat_rate * args.speedup,
+        args.chat_burst
+    )
+    Juzi.caption_editor.client = client
+    # Rates scale with the speedup, bursts stay as configured
+    Juzi.caption_editor.global_bucket = TokenBucket(EDIT_GLOBAL_RATE * args.speedup, EDIT_GLOBAL_RATE)
+    Juzi.caption_editor.chat_buckets.clear()
+    Juzi.EDIT_CHAT_RATE = EDIT_CHAT_RATE * args.speedup
+    Juzi.metrics = Metrics()
+    Juzi.caption_dispatcher = ChatDispatcher(run_caption_job, args.workers)
+    Juzi.caption_dispatcher.start()
+
+    arrivals = traffic(
+        rate, args.duration, channels, dump_channels, args.album_share, args.dumps, args.dump_size, rng
+    )
+    received = {}
+    dump_posts = set()
+    started = time.monotonic()
+    try:
+        for second, chat_id, is_dump in arrivals:
+            delay = started + second / args.speedup - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            document = SimpleNamespace(file_name=rng.choice(filenames), file_size=rng.randint(10 ** 8, 4 * 10 ** 9))
+            message = FakeMessage(client, chat_id, document=document)
+            received[chat_id, message.id] = time.monotonic()
+            if is_dump:
+                dump_posts.add((chat_id, message.id))
+            await Juzi.auto_caption_handler(client, message)
+        await Juzi.caption_dispatcher.drain(args.drain / args.speedup)
+    finally:
+        await Juzi.caption_dispatcher.stop()
+        # Leftovers must not be replayed into the next step
+        await Juzi.caption_jobs_collection.delete_many({})
+
+    regular = [key for key in received if key not in dump_posts]
+    done = [key for key in regular if key in client.completed]
+    latencies = sorted((client.completed[key] - received[key]) * args.speedup for key in done)
+    # Steady state: skip the first quarter while queues fill
+    window_start, window_end = started + args.duration / args.speedup / 4, started + args.duration / args.speedup
+    window = args.duration * 3 / 4
+    arrived = sum(window_start <= received[key] < window_end for key in regular)
+    completed = sum(window_start <= client.completed[key] < window_end for key in done)
+    dumps_finished = max((client.completed.get(key, math.inf) for key in dump_posts), default=started)
+    return {
+        "offered": len(regular) / args.duration,
+        "posts": len(regular),
+        "done": len(done),
+        "arrival_rate": arrived / window,
+        "throughput": completed / window,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "dump_drain": (dumps_finished - started) * args.speedup,
+        "flood_waits": client.calls["flood_wait"],
+    }
+
+
+def saturated(result, slo):
+    return (
+        result["done"] < result["posts"]
+        or result["p99"] > slo
+        or result["throughput"] < 0.8 * result["arrival_rate"]
+    )
+
+
+async def run(args):
+    install_fake_mongo(Counter())
+    channels = [-1002000000000 - n for n in range(args.channels)]
+    # Dumps go to channels of their own so they don't hold up regular posts queued behind them
+    dump_channels = [-1003000000000 - n for n in range(max(args.dumps, 1))]
+    await seed(channels + dump_channels, 0)
+    with open(CORPUS, encoding="utf-8") as corpus:
+        filenames = [line.strip() for line in corpus if line.strip()]
+    rng = random.Random(args.seed)
+
+    print(
+        f"{args.workers} workers, {args.channels} channels, {args.album_share:.0%} albums, "
+        f"{args.dumps} x {args.dump_size}-file dumps per step, {args.duration}s steps, {args.speedup}x speedup\n"
+    )
+    print(
+        f"{'offered/s':>10} {'posts':>7} {'done':>7} {'thru/s':>8} {'p50 s':>8} {'p99 s':>8} "
+        f"{'dumps s':>8} {'floods':>7}"
+    )
+    capacity = None
+    for rate in args.rates:
+        result = await step(args, rate, channels, dump_channels, filenames, rng)
+        print(
+            f"{result['offered']:10.1f} {result['posts']:7d} {result['done']:7d} {result['throughput']:8.1f} "
+            f"{result['p50']:8.2f} {result['p99']:8.2f} {result['dump_drain']:8.0f} {result['flood_waits']:7d}"
+            + ("  saturated" if saturated(result, args.slo) else "")
+        )
+        if saturated(result, args.slo):
+            break
+        capacity = result["offered"]
+
+    if capacity is None:
+        print("\nSaturated at the lowest offered rate")
+    else:
+        print(f"\nSaturation point: ~{capacity:.1f} posts/s with {args.workers} workers")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", default="5,10,20,40,80",
+                        type=lambda rates: [float(rate) for rate in rates.split(",")],
+                        help="offered posts per second, one step each")
+    parser.add_argument("--workers", type=int, default=DISPATCH_WORKERS, help="dispatcher workers")
+    parser.add_argument("--channels", type=int, default=200, help="channels posting")
+    parser.add_argument("--album-share", type=float, default=0.2, help="share of arrivals that are albums of 10")
+    parser.add_argument("--dumps", type=int, default=1, help="bulk uploads into one channel per step")
+    parser.add_argument("--dump-size", type=int, default=500, help="files per bulk upload")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic per step")
+    parser.add_argument("--drain", type=float, default=900, help="seconds to wait for the backlog after a step")
+    parser.add_argument("--slo", type=float, default=30, help="p99 latency in seconds that still counts as keeping up")
+    parser.add_argument("--latency", type=float, default=80, help="simulated API latency in ms")
+    parser.add_argument("--global-rate", type=float, default=30, help="backend edits per second, all chats")
+    parser.add_argument("--chat-rate", type=float, default=1, help="backend edits per second in one chat")
+    parser.add_argument("--chat-burst", type=float, default=3, help="backend per-chat burst")
+    parser.add_argument("--speedup", type=float, default=20, help="run this many times faster than real time")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the traffic")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""Offline replay benchmark for the bot's update handlers.
+
+Feeds channel posts through auto_caption_handler, a mix of menu buttons
+through callback_handler and one /broadcast through broadcast_command, with a
+fake Telegram client that records every edit and send, and mongomock standing
+in for MongoDB. Reports throughput, per-stage latency percentiles and Mongo
+round trips per update, as a baseline to compare performance changes against.
+Startup runs first as in main(), migrating a legacy document and creating the
+indexes. The captioned posts are then fed through again carrying their new
+caption, formatted the way Telegram delivers it, and must all be skipped
+without an edit.
+
+Posts are synthesized from release_filenames.txt, or replayed from a JSON
+lines recording with one {"chat_id", "file_name", "file_size", "caption"}
+object per post. Telegram's edit limits are lifted unless --telegram-limits is
+given, so the numbers measure the bot rather than the rate limiter.
+
+Run from the repository root with the bot's requirements and mongomock-motor
+installed (no network access is needed):
+
+    python benchmarks/replay.py [--posts 5000] [--channels 50] [--latency 0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from mongomock_motor import AsyncMongoMockClient
+from pyrogram.parser import Parser
+from pyrogram.types import MessageEntity
+from pyrogram.types.messages_and_media.message import Str
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Juzi
+from Juzi import CaptionManager, TextSettingsManager, ButtonManager, Metrics, TokenBucket
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "release_filenames.txt")
+
+COLLECTIONS = {
+    "configs_collection": "channel_configs",
+    "users_collection": "users",
+    "dead_letters_collection": "dead_letters",
+    "caption_jobs_collection": "caption_jobs",
+    "backfills_collection": "backfills",
+    "channels_collection": "channel_captions",
+    "text_settings_collection": "text_settings",
+    "button_collection": "custom_buttons",
+}
+
+CAPTION = (
+    "🎬 **{filename}**\n\n"
+    "{#season}📺 Season {season}{/season}{#episode} • Episode {episode}{/episode}\n"
+    "💿 {quality} | 🔊 {language}\n"
+    "📦 {filesize}"
+)
+
+BUTTONS = "[Join][buttonurl:https://t.me/example] [Share][buttonurl:https://t.me/share]"
+
+CALLBACKS = (
+    "help", "start", "text_settings", "custom_button", "text_guide", "button_guide",
+    "view_button", "view_text_settings",
+)
+
+OWNER = SimpleNamespace(id=Juzi.OWNER_ID, first_name="Owner")
+
+
+class CountingCollection:
+    """Proxy that counts every collection method call as one round trip"""
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._counter[f"{self._collection.name}.{name}"] += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+class FakeClient:
+    """Stands in for pyrogram.Client, recording API calls instead of sending them"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.edits = {}
+
+    async def _call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def edit_message_caption(self, chat_id, message_id, caption, reply_markup=None):
+        await self._call("edit_message_caption")
+        self.edits[chat_id, message_id] = caption, reply_markup
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message")
+        return FakeMessage(self, chat_id, text=text)
+
+
+class FakeMessage:
+    """The parts of pyrogram's Message the handlers touch"""
+    _ids = 0
+
+    def __init__(self, client, chat_id, text=None, document=None, caption=None, from_user=None, reply_markup=None):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id, title=f"Channel {chat_id}")
+        self.text = text
+        self.command = text.split() if text and text.startswith("/") else None
+        self.document = document
+        self.video = None
+        self.audio = None
+        self.caption = caption
+        self.reply_markup = reply_markup
+        self.from_user = from_user
+        self.sender_chat = None
+        self.reply_to_message = None
+
+    async def reply(self, text, **kwargs):
+        await self._client._call("reply")
+        return FakeMessage(self._client, self.chat.id, text=text)
+
+    async def edit_text(self, text, **kwargs):
+        await self._client._call("edit_text")
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self._client._call("delete")
+
+
+class FakeCallbackQuery:
+    def __init__(self, client, chat_id, data):
+        self._client = client
+        self.data = data
+        self.from_user = OWNER
+        self.message = FakeMessage(client, chat_id, text="menu", from_user=OWNER)
+
+    async def answer(self, text=None, show_alert=False):
+        await self._client._call("answer")
+
+
+def install_fake_mongo(counter):
+    db = AsyncMongoMockClient()["benchmark"]
+    for attribute, name in COLLECTIONS.items():
+        setattr(Juzi, attribute, CountingCollection(db[name], counter))
+
+
+def lift_rate_limits():
+    Juzi.caption_editor.global_bucket = TokenBucket(1e9)
+    Juzi.caption_editor.chat_buckets.clear()
+    Juzi.EDIT_CHAT_RATE = Juzi.EDIT_CHAT_BURST = 1e9
+    workers, _ = Juzi.Broadcaster.__init__.__defaults__
+    Juzi.Broadcaster.__init__.__defaults__ = (workers, 1e9)
+
+
+def reset_counters(counter):
+    counter.clear()
+    Juzi.metrics = Metrics()
+    Juzi.config_cache.clear()
+
+
+def load_posts(args, channels):
+    if args.recording:
+        with open(args.recording, encoding="utf-8") as recording:
+            return [json.loads(line) for line in recording if line.strip()]
+    with open(CORPUS, encoding="utf-8") as corpus:
+        filenames = [line.strip() for line in corpus if line.strip()]
+    rng = random.Random(args.seed)
+    return [
+        {
+            "chat_id": rng.choice(channels),
+            "file_name": rng.choice(filenames),
+            "file_size": rng.randint(100 * 1024 ** 2, 4 * 1024 ** 3),
+            "caption": None,
+        }
+        for _ in range(args.posts)
+    ]
+
+
+async def startup(counter):
+    """Legacy migration and index bootstrap, as main() runs them before the client starts"""
+    legacy_chat = -1009999999999
+    await Juzi.channels_collection.insert_one({"chat_id": legacy_chat, "caption": "{filename}", "user_id": OWNER.id})
+    # mongomock cursors have no explain(), so the query plan check can only log failures here
+    Juzi.log.disabled = True
+    try:
+        await Juzi.ChannelConfigManager.migrate_legacy_collections()
+        await Juzi.SchemaManager.bootstrap()
+    finally:
+        Juzi.log.disabled = False
+    assert await Juzi.configs_collection.find_one({"chat_id": legacy_chat, "caption.caption": "{filename}"})
+    assert not await Juzi.channels_collection.count_documents({})
+    for collection, key in Juzi.SchemaManager.unique_keys():
+        indexes = await collection.index_information()
+        assert any(info.get("unique") and list(info["key"]) == [(key, 1)] for info in indexes.values()), key
+    await Juzi.configs_collection.delete_one({"chat_id": legacy_chat})
+    counter.clear()
+
+
+async def seed(channels, users):
+    for chat_id in channels:
+        await CaptionManager.set_caption(chat_id, CAPTION, f"Channel {chat_id}", OWNER.id, OWNER.first_name)
+        await TextSettingsManager.add_remove_text(chat_id, "-FLUX", OWNER.id, OWNER.first_name)
+        await TextSettingsManager.add_replace_text(chat_id, "WEB-DL", "WEBDL", OWNER.id, OWNER.first_name)
+        await ButtonManager.set_custom_button(chat_id, BUTTONS, OWNER.id, OWNER.first_name)
+    if users:
+        await Juzi.users_collection.insert_many(
+            [{"user_id": 10 ** 9 + n, "first_name": f"user{n}"} for n in range(users)]
+        )
+
+
+async def as_delivered(caption):
+    """A caption the way pyrogram hands it back: plain text plus the entities parsed out of it"""
+    parsed = await Parser(None).parse(caption)
+    entities = [MessageEntity._parse(None, entity, {}) for entity in parsed["entities"] or []]
+    return Str(parsed["message"]).init(entities)
+
+
+def percentile_ms(histogram, q):
+    return histogram.quantile(q) * 1000 if histogram.count else 0.0
+
+
+def report(title, count, elapsed, counter, unit):
+    print(f"{title}: {count} {unit}s in {elapsed:.2f}s, {count / elapsed:.1f} {unit}s/sec")
+    round_trips = sum(counter.values())
+    print(f"{'mongo round trips per ' + unit:<34} {round_trips / count:8.3f}")
+    for operation, calls in counter.most_common():
+        print(f"  {operation:<32} {calls / count:8.3f}")
+
+
+async def replay_posts(client, posts, counter):
+    reset_counters(counter)
+    messages = []
+    started = time.perf_counter()
+    for post in posts:
+        document = SimpleNamespace(file_name=post["file_name"], file_size=post["file_size"])
+        message = FakeMessage(client, post["chat_id"], document=document, caption=post.get("caption"))
+        messages.append(message)
+        await Juzi.auto_caption_handler(client, message)
+    await Juzi.caption_dispatcher.drain(None)
+    elapsed = time.perf_counter() - started
+
+    report("auto_caption_handler", len(posts), elapsed, counter, "post")
+    print(f"{'captions edited / unchanged':<34} {Juzi.caption_editor.edited:8d} / {Juzi.caption_editor.unchanged}")
+    print(f"\n{'stage':<18} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, histogram in Juzi.metrics.stages.items():
+        print(
+            f"{stage:<18} {histogram.count:8d} {percentile_ms(histogram, 0.5):9.3f} "
+            f"{percentile_ms(histogram, 0.99):9.3f} {histogram.max * 1000:9.3f}"
+        )
+    return messages
+
+
+async def replay_captioned(client, messages, counter):
+    """The same posts again, already showing their caption: none may be edited"""
+    reposts = []
+    for message in messages:
+        if (message.chat.id, message.id) in client.edits:
+            caption, reply_markup = client.edits[message.chat.id, message.id]
+            reposts.append(FakeMessage(
+                client, message.chat.id, document=message.document,
+                caption=await as_delivered(caption), reply_markup=reply_markup
+            ))
+
+    reset_counters(counter)
+    edits, unchanged = client.calls["edit_message_caption"], Juzi.caption_editor.unchanged
+    started = time.perf_counter()
+    for message in reposts:
+        await Juzi.auto_caption_handler(client, message)
+    await Juzi.caption_dispatcher.drain(None)
+    elapsed = time.perf_counter() - started
+
+    assert client.calls["edit_message_caption"] == edits, "already captioned posts were edited"
+    assert Juzi.caption_editor.unchanged - unchanged == len(reposts)
+    report("already captioned posts", len(reposts), elapsed, counter, "post")
+
+
+async def replay_callbacks(client, channels, number, counter):
+    reset_counters(counter)
+    rng = random.Random(0)
+    started = time.perf_counter()
+    for _ in range(number):
+        await Juzi.callback_handler(client, FakeCallbackQuery(client, rng.choice(channels), rng.choice(CALLBACKS)))
+    report("callback_handler", number, time.perf_counter() - started, counter, "callback")
+
+
+async def replay_broadcast(client, users, counter):
+    reset_counters(counter)
+    message = FakeMessage(client, OWNER.id, text="/broadcast Benchmark message", from_user=OWNER)
+    sent_before = client.calls["send_message"]
+    started = time.perf_counter()
+    await Juzi.broadcast_command(client, message)
+    elapsed = time.perf_counter() - started
+    assert client.calls["send_message"] - sent_before == users
+    report("broadcast_command", users, elapsed, counter, "recipient")
+
+
+async def benchmark(args):
+    counter = Counter()
+    install_fake_mongo(counter)
+    if not args.telegram_limits:
+        lift_rate_limits()
+
+    await startup(counter)
+    client = FakeClient(args.latency / 1000)
+    Juzi.caption_editor.client = client
+    channels = [-1001000000000 - n for n in range(args.channels)]
+    await seed(channels, args.users)
+    posts = load_posts(args, channels)
+    print(f"{len(channels)} channels, {len(posts)} posts, {args.users} users, {args.latency}ms API latency\n")
+
+    Juzi.caption_dispatcher.start()
+    try:
+        messages = await replay_posts(client, posts, counter)
+        print()
+        await replay_captioned(client, messages, counter)
+        print()
+        await replay_callbacks(client, channels, args.callbacks, counter)
+        if args.users:
+            print()
+            await replay_broadcast(client, args.users, counter)
+    finally:
+        await Juzi.caption_dispatcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=5000, help="synthetic channel posts to replay")
+    parser.add_argument("--channels", type=int, default=50, help="channels the posts are spread over")
+    parser.add_argument("--callbacks", type=int, default=2000, help="menu button presses to replay")
+    parser.add_argument("--users", type=int, default=2000, help="broadcast recipients (0 skips the broadcast)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Telegram API latency in ms")
+    parser.add_argument("--recording", help="JSON lines file of recorded posts to replay instead")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for synthetic posts")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the configured edit/send rate limits")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
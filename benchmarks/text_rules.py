@@ -0,0 +1,170 @@
+"""Equivalence check and micro-benchmark for compiled text settings.
+
+TextRules rewrites a caption in one regex pass and falls back to applying the
+rules one by one whenever a match could interact with another rule. Its output
+must stay identical to the original remove/replace loop, reproduced below, so
+this script first compares the two on randomized rules and captions drawn
+from tiny alphabets, where overlapping, adjacent and joining matches are
+common, and on captions built from release_filenames.txt. The single pass is
+forced on for the comparison, whatever the rule count. It then times both on
+the corpus, with a few rules that match most captions and with a long list of
+rules that mostly don't, and sweeps the rule count to show where the single
+pass starts to pay off, which is what TextRules.COMPILE_MIN_RULES is set from.
+
+Run from the repository root with the bot's requirements installed:
+
+    python benchmarks/text_rules.py [--cases 600000] [--number 200]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Juzi import TextRules
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "release_filenames.txt")
+
+# Small alphabets make rules collide often enough to exercise every fallback
+ALPHABETS = ("ab", "abc", "ab \n", "aab.-")
+
+# Rules that match most corpus captions, for the sweep
+MATCHING = ["@moviesdump", "-FLUX", "WEB-DL"]
+
+SWEEP = (1, 2, 4, 8, 12, 16, 24, 32, 48, 64)
+
+SETTINGS = {
+    "few rules": {
+        "remove_texts": ["@moviesdump", "-FLUX", "[Tamil]", "www.example.com - "],
+        "replace_texts": {"WEB-DL": "WEBDL", "x265": "HEVC", "Dual Audio": "Dual"},
+    },
+    "160 rules": {
+        "remove_texts": [f"@channel{number}" for number in range(80)],
+        "replace_texts": {f"[Tag{number}]": f"#tag{number}" for number in range(80)},
+    },
+}
+
+
+def sequential(caption, settings):
+    """The remove/replace loop text settings used before TextRules"""
+    if not settings:
+        return caption
+
+    if 'remove_texts' in settings:
+        for text_to_remove in settings['remove_texts']:
+            caption = caption.replace(text_to_remove, '')
+
+    if 'replace_texts' in settings:
+        for old_text, new_text in settings['replace_texts'].items():
+            caption = caption.replace(old_text, new_text)
+
+    caption = re.sub(r'\n\s*\n', '\n\n', caption)
+    return caption.strip()
+
+
+@contextmanager
+def always_compiled():
+    """Let TextRules compile any rule set, however short"""
+    threshold = TextRules.COMPILE_MIN_RULES
+    TextRules.COMPILE_MIN_RULES = 0
+    try:
+        yield
+    finally:
+        TextRules.COMPILE_MIN_RULES = threshold
+
+
+def random_case(rng, alphabet, max_length):
+    def text(low, high):
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(low, high)))
+
+    settings = {}
+    if rng.random() < 0.8:
+        settings["remove_texts"] = list(dict.fromkeys(text(1, 3) for _ in range(rng.randint(0, 3))))
+    if rng.random() < 0.8:
+        settings["replace_texts"] = {text(1, 3): text(0, 3) for _ in range(rng.randint(0, 3))}
+    # Chats without text settings never reach the rules; this is one whose rules were all deleted
+    if not settings:
+        settings["remove_texts"] = []
+    return text(0, max_length), settings
+
+
+def check_random(cases, seed):
+    rng = random.Random(seed)
+    single_pass = 0
+    for number in range(cases):
+        alphabet = ALPHABETS[number % len(ALPHABETS)]
+        caption, settings = random_case(rng, alphabet, rng.choice((8, 24, 60)))
+        rules = TextRules.from_settings(settings)
+        single_pass += rules.single_pass
+        assert rules.apply(caption) == sequential(caption, settings), (caption, settings)
+    print(f"{cases} random cases identical, {single_pass / cases:.0%} compiled to a single pass")
+
+
+def corpus_captions(path):
+    with open(path, encoding="utf-8") as corpus:
+        filenames = [line.strip() for line in corpus if line.strip()]
+    return [f"🎬 **{name}**\n\n\n💿 @moviesdump | {name.replace('.', ' ')}\n" for name in filenames]
+
+
+def run(label, apply, captions, number):
+    def one_pass():
+        for caption in captions:
+            apply(caption)
+
+    total = timeit.timeit(one_pass, number=number)
+    per_call = total / (number * len(captions)) * 1e6
+    print(f"{label:<34} {per_call:8.3f} us/caption")
+    return per_call
+
+
+def sweep(captions, number):
+    """Single pass against the loop by rule count, with MATCHING among the rules"""
+    print(f"{'rules':>5} {'loop us':>9} {'compiled us':>12} {'speedup':>8}")
+    for count in SWEEP:
+        texts = MATCHING[:count] + [f"@channel{number}" for number in range(count - len(MATCHING))]
+        settings = {"remove_texts": texts}
+        with always_compiled():
+            rules = TextRules.from_settings(settings)
+        loop = timeit.timeit(lambda: [sequential(caption, settings) for caption in captions], number=number)
+        compiled = timeit.timeit(lambda: [rules.apply(caption) for caption in captions], number=number)
+        scale = 1e6 / (number * len(captions))
+        print(f"{count:5d} {loop * scale:9.3f} {compiled * scale:12.3f} {loop / compiled:7.2f}x")
+    print(f"\nTextRules.COMPILE_MIN_RULES = {TextRules.COMPILE_MIN_RULES}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", type=int, default=600000, help="randomized rule sets to compare")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the comparison")
+    parser.add_argument("--number", type=int, default=200, help="timed passes over the corpus")
+    parser.add_argument("--corpus", default=CORPUS, help="file with one filename per line")
+    args = parser.parse_args()
+
+    captions = corpus_captions(args.corpus)
+    with always_compiled():
+        check_random(args.cases, args.seed)
+        for settings in SETTINGS.values():
+            rules = TextRules.from_settings(settings)
+            for caption in captions:
+                assert rules.apply(caption) == sequential(caption, settings), caption
+    print(f"{len(captions)} corpus captions identical, {args.number} passes\n")
+
+    # As deployed: short rule lists keep the loop
+    compiled = {label: TextRules.from_settings(settings) for label, settings in SETTINGS.items()}
+
+    for label, settings in SETTINGS.items():
+        before = run(
+            f"{label} (remove/replace loop)", lambda caption: sequential(caption, settings), captions, args.number
+        )
+        after = run(f"{label} (TextRules)", compiled[label].apply, captions, args.number)
+        print(f"{'speedup':<34} {before / after:8.2f}x\n")
+
+    sweep(captions, args.number)
+
+
+if __name__ == "__main__":
+    main()
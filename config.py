@@ -28,3 +28,58 @@ OWNER_ID =
 
 
 
+
+# Per-chat config cache: max chats kept in memory and seconds before re-reading Mongo
+CONFIG_CACHE_SIZE = 5000
+CONFIG_CACHE_TTL = 300
+
+# Parsed file info kept for files that are forwarded to several channels
+FILE_INFO_CACHE_SIZE = 2048
+
+# Broadcast: concurrent senders, messages per second (Telegram allows ~30) and attempts per user
+BROADCAST_WORKERS = 20
+BROADCAST_RATE = 25
+BROADCAST_RETRIES = 5
+
+# Channels captioned in parallel; posts within one channel are always handled in order
+DISPATCH_WORKERS = 16
+# Seconds to finish queued captions on shutdown (Heroku allows 30 after SIGTERM)
+SHUTDOWN_DRAIN_TIMEOUT = 20
+# Message ids remembered per channel to skip redelivered posts
+RECENT_POSTS_PER_CHAT = 512
+
+# Caption edits: global and per-chat edits per second, per-chat burst and attempts
+EDIT_GLOBAL_RATE = 30
+EDIT_CHAT_RATE = 1
+EDIT_CHAT_BURST = 5
+EDIT_RETRIES = 5
+
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics); set the port to 0 to disable
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# /profile window in seconds (default and maximum), functions listed, slow-callback threshold in seconds
+PROFILE_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40
+PROFILE_SLOW_CALLBACK = 0.1
+
+# Log level, and how many records of the same message and chat are written per window (seconds)
+LOG_LEVEL = "INFO"
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 60
+
+# /recaption: messages fetched per get_messages call (Telegram allows up to 200) and edits in flight
+BACKFILL_BATCH = 200
+BACKFILL_CONCURRENCY = 4
+
+# /start user tracking: users remembered as already stored, and buffered writes flushed per batch or interval (seconds)
+KNOWN_USERS_CACHE_SIZE = 100000
+USER_FLUSH_BATCH = 500
+USER_FLUSH_INTERVAL = 5
+
+# Seconds between recounts of the /stats totals against MongoDB
+STATS_RECONCILE_INTERVAL = 600
+
+# Captions per /mycaptions page
+MYCAPTIONS_PAGE_SIZE = 10